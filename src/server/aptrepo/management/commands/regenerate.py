@@ -0,0 +1,43 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+from server.aptrepo.views import get_repository_controller
+from server.aptrepo.management.util import init_cli_logger
+
+class Command(BaseCommand):
+    """
+    'regenerate' admin command
+    """
+    help = _('Rebuilds the metadata of invalidated distributions in the background ' \
+             '(see APTREPO_BACKGROUND_REGENERATION)')
+    option_list = (
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help=_('Regenerate the dirty distributions once and exit')),
+        make_option('--interval',
+            action='store',
+            type='float',
+            dest='interval',
+            default=1.0,
+            help=_('Seconds between checks for dirty distributions')),
+        ) + BaseCommand.option_list
+
+    def handle(self, *args, **options):
+
+        logger = init_cli_logger(options)
+
+        try:
+            repository = get_repository_controller(logger, sys_user=True)
+            while True:
+                repository.regenerate_dirty_distributions()
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            raise CommandError(e)
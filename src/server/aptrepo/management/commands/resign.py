@@ -0,0 +1,40 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+from server.aptrepo.views import get_repository_controller
+from server.aptrepo.management.util import init_cli_logger
+
+class Command(BaseCommand):
+    """
+    'resign' admin command
+    """
+    args = _('[distribution ...]')
+    help = _('Re-signs the Release files of the distributions and publishes the public ' \
+             'key (e.g. after rotating GPG_SECRET_KEY) without rebuilding the indexes')
+    option_list = (
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=None,
+            help=_('Number of distributions to re-sign concurrently ' \
+                   '(defaults to APTREPO_METADATA_WORKERS)')),
+        ) + BaseCommand.option_list
+
+    def handle(self, *args, **options):
+
+        logger = init_cli_logger(options)
+
+        try:
+            repository = get_repository_controller(logger, sys_user=True)
+            results = repository.resign_distributions(args or None,
+                                                      num_workers=options['workers'])
+            for (distribution_name, resigned) in results:
+                if resigned:
+                    self.stdout.write('{0}: re-signed\n'.format(distribution_name))
+                else:
+                    self.stdout.write('{0}: not cached (signed when rebuilt)\n'.format(
+                        distribution_name))
+
+        except Exception as e:
+            raise CommandError(e)
@@ -0,0 +1,42 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+from server.aptrepo.management.util import init_cli_logger
+from server.aptrepo.util.signing import SigningServer
+
+class Command(BaseCommand):
+    """
+    'runsigner' admin command
+    """
+    help = _('Runs the signing daemon which signs the Release files for the other ' \
+             'processes (see APTREPO_SIGNING_SOCKET)')
+    option_list = (
+        make_option('--socket',
+            action='store',
+            dest='socket_path',
+            default=None,
+            help=_('Unix socket to listen on (defaults to APTREPO_SIGNING_SOCKET)')),
+        ) + BaseCommand.option_list
+
+    def handle(self, *args, **options):
+
+        logger = init_cli_logger(options)
+
+        socket_path = options['socket_path'] or settings.APTREPO_SIGNING_SOCKET
+        if not socket_path:
+            raise CommandError(_('No socket specified and APTREPO_SIGNING_SOCKET is not set'))
+
+        server = None
+        try:
+            server = SigningServer(socket_path)
+            logger.info('Signing daemon listening on: ' + socket_path)
+            server.serve_forever()
+
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            raise CommandError(e)
+        finally:
+            if server:
+                server.server_close()
@@ -0,0 +1,41 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+from server.aptrepo.views import get_repository_controller
+from server.aptrepo.management.util import init_cli_logger
+
+class Command(BaseCommand):
+    """
+    'warm' admin command
+    """
+    args = _('[distribution ...]')
+    help = _('Builds and signs the metadata of the distributions ahead of client requests')
+    option_list = (
+        make_option('--all',
+            action='store_true',
+            dest='rebuild_all',
+            default=False,
+            help=_('Rebuild the index files which are still cached')),
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=None,
+            help=_('Number of distributions to warm concurrently ' \
+                   '(defaults to APTREPO_METADATA_WORKERS)')),
+        ) + BaseCommand.option_list
+
+    def handle(self, *args, **options):
+
+        logger = init_cli_logger(options)
+
+        try:
+            repository = get_repository_controller(logger, sys_user=True)
+            timings = repository.warm_distributions(args or None,
+                                                    rebuild_all=options['rebuild_all'],
+                                                    num_workers=options['workers'])
+            for (distribution_name, elapsed) in timings:
+                self.stdout.write('{0}: {1:.2f}s\n'.format(distribution_name, elapsed))
+
+        except Exception as e:
+            raise CommandError(e)
@@ -1,5 +1,6 @@
 import os
 import re
+import time
 from django.contrib.auth.models import User, Group
 from django.db import models
 from django.core.exceptions import ValidationError
@@ -13,6 +14,14 @@ def nowhitespace(value):
     if re.search('\s+', value):
         raise ValidationError(_("'{0}' contains whitespace").format(value))
 
+def new_metadata_generation():
+    """
+    Initial generation of a distribution's metadata, which starts from the current time
+    so that a recreated distribution never repeats a generation that processes may 
+    still hold in memory
+    """
+    return int(time.time() * 1000)
+
 def uniquefile_upload_path(instance, filename):
     """
     Simple method to just store the filename
@@ -60,6 +69,13 @@ class Package(UniqueFile):
     version = models.CharField(max_length=255, db_index=True)
     control = models.TextField()
     
+    # pre-rendered entry for the Packages list (empty if not rendered yet)
+    stanza = models.TextField(blank=True)
+    
+    # newline separated list of the files in the package (null if not captured yet and
+    # empty if the package file couldn't be listed)
+    contents = models.TextField(null=True, blank=True)
+    
     def __unicode__(self):
         return '({0}, {1}, {2})'.format(self.package_name, self.architecture, 
                                         self.version)
@@ -98,6 +114,9 @@ class Distribution(models.Model):
     creation_date = models.DateTimeField(auto_now_add=True)
     suppported_architectures = models.ManyToManyField(Architecture, 
                                                       db_table='aptrepo_dist_architectures')
+    # advanced whenever any of the distribution's metadata is rebuilt or invalidated
+    metadata_generation = models.BigIntegerField(default=new_metadata_generation, 
+                                                 editable=False)
     
     def __unicode__(self):
         return self.name
@@ -144,6 +163,36 @@ class Section(models.Model):
         return '{0}:{1}'.format(self.distribution.name, self.name)
 
     
+class IndexFile(models.Model):
+    """
+    Size and hashes of an index file listed in the Release file of a distribution
+    (persisted so that the Release file can be rebuilt without rehashing the 
+    index files which haven't changed)
+    """
+    class Meta:
+        unique_together = (('distribution', 'path'),)
+        
+    distribution = models.ForeignKey('Distribution', db_index=True)
+    section = models.CharField(max_length=255, db_index=True)
+    architecture = models.CharField(max_length=255, db_index=True)
+    path = models.CharField(max_length=255) # relative to the distribution's directory
+    size = models.IntegerField(default=0)
+    hash_md5 = models.CharField(max_length=16*2)
+    hash_sha1 = models.CharField(max_length=20*2)
+    hash_sha256 = models.CharField(max_length=32*2)
+    
+    # generation of the distribution's metadata the entry belongs to (entries of older
+    # generations are ignored, see Distribution.metadata_generation)
+    generation = models.BigIntegerField(default=0)
+    
+    # value of APTREPO_SEPARATE_ARCHITECTURE_ALL when the index file was built (entries
+    # built under the other value are ignored since they list different packages)
+    separate_architecture_all = models.BooleanField(default=False)
+    
+    def __unicode__(self):
+        return '{0}:{1}'.format(self.distribution.name, self.path)
+
+    
 class PackageInstance(models.Model):
     """ 
     Package instance 
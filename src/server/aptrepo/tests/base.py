@@ -54,6 +54,8 @@ class BaseAptRepoTest(TestCase):
         cache_dir = settings.CACHES['default']['LOCATION']
         if os.path.exists(cache_dir):
             shutil.rmtree(cache_dir)
+        if os.path.exists(settings.APTREPO_METADATA_ROOT):
+            shutil.rmtree(settings.APTREPO_METADATA_ROOT)
         
         # GPG context for signature verification
         self.gpg_context = pyme.core.Context()
@@ -113,14 +115,23 @@ class BaseAptRepoTest(TestCase):
                 else:
                     os.remove(fullpath_entry)
 
-    def _create_package(self, control_map, pkg_filename):
+    def _create_package(self, control_map, pkg_filename, files={}):
         """
         Creates a Debian package
+        
+        files - (optional) dictionary mapping the relative path of each file to include
+                in the package to its contents
         """
         try:
             pkgsrc_dir = tempfile.mkdtemp()
             debian_dir = os.path.join(pkgsrc_dir,'DEBIAN') 
             os.mkdir(debian_dir)
+            for (filename, content) in files.items():
+                file_path = os.path.join(pkgsrc_dir, filename)
+                if not os.path.exists(os.path.dirname(file_path)):
+                    os.makedirs(os.path.dirname(file_path))
+                with open(file_path, 'wb') as fh:
+                    fh.write(content)
             with open(os.path.join(debian_dir,'control'), 'wt') as fh_control:
                 control_map.dump(fh_control)
             
@@ -151,6 +162,23 @@ class BaseAptRepoTest(TestCase):
                 })
             self.failUnlessEqual(response.status_code, 302)
 
+    def _upload_new_package(self, control_map, files={}):
+        """
+        Creates a Debian package in a temporary file and uploads it to the apt repo
+
+        control_map - control fields of the package
+        files - (optional) files to include in the package (see _create_package)
+        """
+        pkg_filename = None
+        try:
+            pkg_fh, pkg_filename = tempfile.mkstemp(suffix='.deb', prefix=control_map['Package'])
+            os.close(pkg_fh)
+            self._create_package(control_map, pkg_filename, files)
+            self._upload_package(pkg_filename)
+        finally:
+            if pkg_filename is not None:
+                os.remove(pkg_filename)
+
     def _exists_package(self, package_name, version, architecture):
         """
         Inspects a section to determine whether a package exists
@@ -187,6 +215,22 @@ class BaseAptRepoTest(TestCase):
         self.failUnlessEqual(result.signatures[0].status, 0)
         self.failUnlessEqual(result.signatures[0].summary, 0)
 
+    def _verify_gpg_inline_signature(self, content, signed_content):
+        """
+        Verifies an inline (clear-signed) GPG signature and that it contains the content
+        """
+        signed_data = pyme.core.Data(string=signed_content)
+        plain_data = pyme.core.Data()
+        self.gpg_context.op_verify(signed_data, None, plain_data)
+        
+        result = self.gpg_context.op_verify_result()
+        self.failUnlessEqual(len(result.signatures), 1)
+        self.failUnlessEqual(result.signatures[0].status, 0)
+        self.failUnlessEqual(result.signatures[0].summary, 0)
+        
+        plain_data.seek(0, 0)
+        self.failUnlessEqual(plain_data.read().rstrip('\n'), content.rstrip('\n'))
+
     def _verify_repo_metadata(self):
         """
         Verifies all the metafiles of the repository
@@ -196,6 +240,8 @@ class BaseAptRepoTest(TestCase):
         release_content = self._download_content(root_distribution_url + '/Release')
         release_signature = self._download_content(root_distribution_url + '/Release.gpg')
         self._verify_gpg_signature(release_content, release_signature)
+        inline_release = self._download_content(root_distribution_url + '/InRelease')
+        self._verify_gpg_inline_signature(release_content, inline_release)
         
         # parse each of the Release file entries
         distribution = deb822.Release(sequence=release_content,
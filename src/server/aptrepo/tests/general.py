@@ -2,16 +2,26 @@
 General unit tests for apt repo
 """
 
+import cStringIO
 import hashlib
 import json
 import os
 import shutil
+import socket
+import stat
 import tempfile
+import threading
+import time
 import zlib
 from debian_bundle import deb822, debfile
 from django.conf import settings
+from lockfile import FileLock
 from server.aptrepo import models
-from server.aptrepo.util.hash import hash_file_by_fh
+from server.aptrepo.util import AptRepoException, AuthorizationException
+from server.aptrepo.util.hash import get_gpg_signer_pool, hash_file_by_fh
+from server.aptrepo.util.signing import SigningClient, SigningServer, sign_releases
+from server.aptrepo.util.system import remove_file
+from server.aptrepo.views import get_repository_controller
 from base import BaseAptRepoTest, skipRepoTestIfExcluded
 
 
@@ -124,6 +134,18 @@ class SmallRepositoryTest(BaseAptRepoTest):
             self.assertTrue(self._exists_package(control_map['Package'], control_map['Version'], 
                             control_map['Architecture']))
             
+            # verify the Packages list uses the entry rendered at upload time
+            package = models.Package.objects.get(package_name=control_map['Package'],
+                                                 version=control_map['Version'],
+                                                 architecture=control_map['Architecture'])
+            packages_content = self._download_content(
+                '{0}/dists/{1}/{2}/binary-{3}/Packages'.format(self._ROOT_WEBDIR,
+                                                               self.distribution_name,
+                                                               self.section_name,
+                                                               control_map['Architecture']))
+            self.assertTrue(package.stanza)
+            self.assertTrue(package.stanza in packages_content)
+            
             # test removing the package
             self._remove_package(control_map['Package'], control_map['Version'], 
                                  control_map['Architecture'])
@@ -186,6 +208,718 @@ class SmallRepositoryTest(BaseAptRepoTest):
             self._verify_package_download(self.distribution_name, self.section_name, 
                                           package_name, test_architecture, version)
 
+    @skipRepoTestIfExcluded
+    def test_incremental_metadata_update(self):
+        """
+        Test that package changes applied as deltas to the cached metadata
+        match a full rebuild of the metadata
+        """
+        root_distribution_url = self._ROOT_WEBDIR + '/dists/' + self.distribution_name
+        index_urls = []
+        for architecture in ('i386', 'amd64'):
+            index_urls.append('{0}/{1}/binary-{2}/Packages'.format(root_distribution_url, 
+                                                                   self.section_name,
+                                                                   architecture))
+            index_urls.append('{0}/{1}/Contents-{2}.gz'.format(root_distribution_url, 
+                                                               self.section_name,
+                                                               architecture))
+        
+        for (package_name, architecture) in (('incr-a', 'i386'), ('incr-b', 'all'), ('incr-c', 'amd64')):
+            control_map = self._make_common_debcontrol()
+            control_map['Package'] = package_name
+            control_map['Architecture'] = architecture
+            
+            # ensure the metadata is cached so that the upload is applied as a delta
+            self._download_content(root_distribution_url + '/Release')
+            self._upload_new_package(control_map, 
+                                     { 'usr/share/doc/incr/README' : 'shared file',
+                                       'usr/bin/' + package_name : package_name })
+                    
+        self._remove_package('incr-a', '1.00', 'i386')
+        self._verify_repo_metadata()
+        
+        incremental_release = self._download_content(root_distribution_url + '/Release')
+        incremental_indexes = [self._download_content(url) for url in index_urls]
+        
+        # force a full rebuild and compare the results
+        repository = get_repository_controller(sys_user=True)
+        repository._clear_cache(self.distribution_name)
+        self.failUnlessEqual(self._download_content(root_distribution_url + '/Release'), 
+                             incremental_release)
+        for (url, index_content) in zip(index_urls, incremental_indexes):
+            self.failUnlessEqual(self._download_content(url), index_content)
+        
+    @skipRepoTestIfExcluded
+    def test_published_metadata(self):
+        """
+        Test that the metadata files are published under the public directory
+        """
+        metadata_root = os.path.join(settings.MEDIA_ROOT, 
+                                     settings.APTREPO_FILESTORE['metadata_subdir'],
+                                     self.distribution_name)
+        release_filename = os.path.join(metadata_root, 'Release')
+        packages_filename = os.path.join(metadata_root, self.section_name, 'binary-i386', 'Packages')
+        
+        settings.APTREPO_PUBLISH_METADATA = True
+        try:
+            self._upload_new_package(self._make_common_debcontrol())
+            
+            # the published files must match the metadata served by django
+            root_distribution_url = self._ROOT_WEBDIR + '/dists/' + self.distribution_name
+            release_content = self._download_content(root_distribution_url + '/Release')
+            with open(release_filename) as fh:
+                self.failUnlessEqual(fh.read(), release_content)
+            packages_content = self._download_content(
+                '{0}/{1}/binary-i386/Packages'.format(root_distribution_url, self.section_name))
+            with open(packages_filename) as fh:
+                self.failUnlessEqual(fh.read(), packages_content)
+            
+            # the published list is the by-hash copy listed in the Release file
+            by_hash_filename = os.path.join(os.path.dirname(packages_filename), 'by-hash', 
+                                            'SHA256', hashlib.sha256(packages_content).hexdigest())
+            self.assertTrue(os.path.samefile(packages_filename, by_hash_filename))
+            
+            # invalidating the metadata must remove the published Release file, and the 
+            # index files are replaced once the metadata is rebuilt
+            repository = get_repository_controller(sys_user=True)
+            repository._clear_cache(self.distribution_name)
+            self.assertFalse(os.path.exists(release_filename))
+            self.failUnlessEqual(self._download_content(root_distribution_url + '/Release'),
+                                 release_content)
+            self.assertTrue(os.path.exists(release_filename))
+            self.assertTrue(os.path.samefile(packages_filename, by_hash_filename))
+            
+        finally:
+            settings.APTREPO_PUBLISH_METADATA = False
+        
+    @skipRepoTestIfExcluded
+    def test_by_hash_metadata(self):
+        """
+        Test that every index file in the Release file can be retrieved by its hash
+        and that previous generations are retained
+        """
+        root_distribution_url = self._ROOT_WEBDIR + '/dists/' + self.distribution_name
+        packages_url = '{0}/{1}/binary-i386/Packages'.format(root_distribution_url, 
+                                                            self.section_name)
+        contents_url = '{0}/{1}/Contents-i386.gz'.format(root_distribution_url, 
+                                                         self.section_name)
+        old_packages_content = self._download_content(packages_url)
+        old_contents = self._download_content(contents_url)
+
+        control_map = self._make_common_debcontrol()
+        control_map['Package'] = 'byhash-test'
+        self._upload_new_package(control_map, files={'usr/bin/byhash-test' : 'test'})
+            
+        release_content = self._download_content(root_distribution_url + '/Release')
+        release = deb822.Release(sequence=release_content)
+        self.failUnlessEqual(release['Acquire-By-Hash'], 'yes')
+        for entry in release['SHA256']:
+            by_hash_url = '{0}/{1}/by-hash/SHA256/{2}'.format(
+                root_distribution_url, os.path.dirname(entry['name']), entry['sha256'])
+            response = self.client.get(by_hash_url)
+            self.failUnlessEqual(response.status_code, 200)
+            self.failUnlessEqual(hashlib.sha256(response.content).hexdigest(), entry['sha256'])
+            self.failUnlessEqual(int(response['Content-Length']), int(entry['size']))
+            self.assertTrue('max-age' in response['Cache-Control'])
+            
+        # the previous generation of the Packages list remains available
+        old_digest = hashlib.sha256(old_packages_content).hexdigest()
+        by_hash_url = '{0}/{1}/binary-i386/by-hash/SHA256/{2}'.format(
+            root_distribution_url, self.section_name, old_digest)
+        self.failUnlessEqual(self._download_content(by_hash_url), old_packages_content)
+        
+        # the Contents indexes are stored by hash in the section's directory
+        sha256_entries = dict((entry['name'], entry['sha256']) for entry in release['SHA256'])
+        contents_digest = sha256_entries['{0}/Contents-i386.gz'.format(self.section_name)]
+        self.failUnlessEqual(contents_digest, 
+                             hashlib.sha256(self._download_content(contents_url)).hexdigest())
+        old_digest = hashlib.sha256(old_contents).hexdigest()
+        self.assertNotEqual(old_digest, contents_digest)
+        by_hash_url = '{0}/{1}/by-hash/SHA256/{2}'.format(
+            root_distribution_url, self.section_name, old_digest)
+        self.failUnlessEqual(self._download_content(by_hash_url), old_contents)
+
+    @skipRepoTestIfExcluded
+    def test_packages_diff(self):
+        """
+        Test that the PDiff patches transform the previous Packages list into the
+        current one
+        """
+        root_distribution_url = self._ROOT_WEBDIR + '/dists/' + self.distribution_name
+        packages_url = '{0}/{1}/binary-i386/Packages'.format(root_distribution_url, 
+                                                            self.section_name)
+        old_packages_content = self._download_content(packages_url)
+
+        control_map = self._make_common_debcontrol()
+        control_map['Package'] = 'pdiff-test'
+        self._upload_new_package(control_map)
+        packages_content = self._download_content(packages_url)
+        
+        diff_index = deb822.Deb822(
+            sequence=self._download_content(packages_url + '.diff/Index'))
+        (current_hash, current_size) = diff_index['SHA256-Current'].split()
+        self.failUnlessEqual(current_hash, hashlib.sha256(packages_content).hexdigest())
+        self.failUnlessEqual(int(current_size), len(packages_content))
+        
+        # apply the most recent patch to the previous list
+        (old_hash, _, patch_name) = diff_index['SHA256-History'].split('\n')[-1].split()
+        self.failUnlessEqual(old_hash, hashlib.sha256(old_packages_content).hexdigest())
+        compressed_patch = self._download_content(
+            '{0}.diff/{1}.gz'.format(packages_url, patch_name))
+        patch = zlib.decompress(compressed_patch, 16 + zlib.MAX_WBITS)
+        self.failUnlessEqual(self._apply_ed_diff(old_packages_content, patch), 
+                             packages_content)
+        
+        # patches never change, so they are validated by their digest
+        patch_url = '{0}.diff/{1}.gz'.format(packages_url, patch_name)
+        response = self.client.get(patch_url)
+        self.failUnlessEqual(response['ETag'], 
+                             '"{0}"'.format(hashlib.sha256(compressed_patch).hexdigest()))
+        response = self.client.get(patch_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.failUnlessEqual(response.status_code, 304)
+        
+        # the index and the patches are also available by hash
+        (patch_hash, _, _) = diff_index['SHA256-Download'].split('\n')[-1].split()
+        by_hash_url = '{0}.diff/by-hash/SHA256/{1}'.format(packages_url, patch_hash)
+        self.failUnlessEqual(self._download_content(by_hash_url), compressed_patch)
+        diff_index_content = self._download_content(packages_url + '.diff/Index')
+        by_hash_url = '{0}.diff/by-hash/SHA256/{1}'.format(
+            packages_url, hashlib.sha256(diff_index_content).hexdigest())
+        self.failUnlessEqual(self._download_content(by_hash_url), diff_index_content)
+
+    @skipRepoTestIfExcluded
+    def test_contents_index(self):
+        """
+        Test that the Contents index lists the files of uploaded packages
+        """
+        control_map = self._make_common_debcontrol()
+        control_map['Package'] = 'contents-test'
+        control_map['Section'] = 'utils'
+        self._upload_new_package(control_map, files={'usr/bin/contents-test' : 'test'})
+                
+        package = models.Package.objects.get(package_name='contents-test')
+        self.failUnlessEqual(package.contents, 'usr/bin/contents-test')
+        
+        contents_url = '{0}/dists/{1}/{2}/Contents-i386.gz'.format(
+            self._ROOT_WEBDIR, self.distribution_name, self.section_name)
+        contents = zlib.decompress(self._download_content(contents_url), 16 + zlib.MAX_WBITS)
+        self.assertTrue('usr/bin/contents-test\tutils/contents-test\n' in contents)
+        
+        # a package whose file list can't be captured is left out of the Contents index
+        # without breaking the other index files
+        models.Package.objects.filter(pk=package.pk).update(contents=None)
+        os.remove(package.path.path)
+        repository = get_repository_controller(sys_user=True)
+        repository._clear_cache(self.distribution_name)
+        contents = zlib.decompress(self._download_content(contents_url), 16 + zlib.MAX_WBITS)
+        self.assertFalse('usr/bin/contents-test' in contents)
+        self._verify_repo_metadata()
+        
+        # the package is only examined once
+        self.failUnlessEqual(models.Package.objects.get(pk=package.pk).contents, '')
+
+    @skipRepoTestIfExcluded
+    def test_contents_index_removed_instance(self):
+        """
+        Test that removing one of two instances of a package from a section keeps its 
+        files in the Contents index
+        """
+        control_map = self._make_common_debcontrol()
+        control_map['Package'] = 'contents-instances'
+        control_map['Section'] = 'utils'
+        self._upload_new_package(control_map, files={'usr/bin/contents-instances' : 'test'})
+        
+        contents_url = '{0}/dists/{1}/{2}/Contents-i386.gz'.format(
+            self._ROOT_WEBDIR, self.distribution_name, self.section_name)
+        self._download_content(contents_url)
+        
+        repository = get_repository_controller(sys_user=True)
+        package = models.Package.objects.get(package_name='contents-instances')
+        section = models.Section.objects.get(id=self.section_id)
+        instance_id = repository.clone_package(section, package_id=package.id)
+        repository.remove_package(instance_id)
+        
+        contents = self._download_content(contents_url)
+        self.assertTrue('usr/bin/contents-instances\tutils/contents-instances\n' in 
+                        zlib.decompress(contents, 16 + zlib.MAX_WBITS))
+        
+        # the delta must match a full rebuild
+        repository._clear_cache(self.distribution_name)
+        self.failUnlessEqual(self._download_content(contents_url), contents)
+
+    @skipRepoTestIfExcluded
+    def test_separate_architecture_all(self):
+        """
+        Test publishing architecture independent packages in binary-all and that 
+        changing the setting never reuses the index files built under the other value
+        """
+        root_distribution_url = self._ROOT_WEBDIR + '/dists/' + self.distribution_name
+        
+        def count_packages(architecture):
+            packages_content = self._download_content('{0}/{1}/binary-{2}/Packages'.format(
+                root_distribution_url, self.section_name, architecture))
+            return len([ package for package in deb822.Packages.iter_paragraphs(
+                         sequence=packages_content.splitlines()) 
+                         if package['Package'] == 'arch-all-test' ])
+        
+        self._download_content(root_distribution_url + '/Release')
+        settings.APTREPO_SEPARATE_ARCHITECTURE_ALL = True
+        try:
+            control_map = self._make_common_debcontrol()
+            control_map['Package'] = 'arch-all-test'
+            control_map['Architecture'] = 'all'
+            self._upload_new_package(control_map)
+            
+            self._verify_repo_metadata()
+            release = deb822.Release(
+                sequence=self._download_content(root_distribution_url + '/Release'))
+            self.assertTrue('all' in release['Architectures'].split())
+            self.failUnlessEqual(count_packages('all'), 1)
+            self.failUnlessEqual(count_packages('i386'), 0)
+        
+        finally:
+            settings.APTREPO_SEPARATE_ARCHITECTURE_ALL = False
+        
+        # an unrelated change rebuilds the index files of the other architectures too
+        control_map = self._make_common_debcontrol()
+        control_map['Package'] = 'arch-amd64-test'
+        control_map['Architecture'] = 'amd64'
+        self._upload_new_package(control_map)
+        
+        self._verify_repo_metadata()
+        release = deb822.Release(
+            sequence=self._download_content(root_distribution_url + '/Release'))
+        self.assertFalse('all' in release['Architectures'].split())
+        self.failUnlessEqual(count_packages('i386'), 1)
+        self.failUnlessEqual(count_packages('amd64'), 1)
+
+    @skipRepoTestIfExcluded
+    def test_background_regeneration(self):
+        """
+        Test that invalidated metadata is served until it is regenerated in the background
+        """
+        repository = get_repository_controller(sys_user=True)
+        release_url = '{0}/dists/{1}/Release'.format(self._ROOT_WEBDIR, self.distribution_name)
+        release_content = self._download_content(release_url)
+        
+        settings.APTREPO_BACKGROUND_REGENERATION = True
+        try:
+            repository._invalidate_metadata(self.distribution_name)
+            repository._invalidate_metadata(self.distribution_name)
+            self.assertTrue(repository._get_invalidation_times(self.distribution_name))
+            self.failUnlessEqual(self._download_content(release_url), release_content)
+            
+            # regeneration is deferred until the invalidations have settled
+            self.failUnlessEqual(repository.regenerate_dirty_distributions(delay=3600), [])
+            
+            # a failed rebuild keeps the distribution dirty
+            def fail_refresh(distribution_name, **kwargs):
+                raise AptRepoException('Rebuild failed: ' + distribution_name)
+            repository._refresh_releases_data = fail_refresh
+            try:
+                self.failUnlessEqual(repository.regenerate_dirty_distributions(delay=0), [])
+            finally:
+                del repository._refresh_releases_data
+            self.assertTrue(repository._get_invalidation_times(self.distribution_name))
+            
+            self.failUnlessEqual(repository.regenerate_dirty_distributions(delay=0), 
+                                 [self.distribution_name])
+            self.assertFalse(repository._get_invalidation_times(self.distribution_name))
+            self.failUnlessEqual(repository.regenerate_dirty_distributions(delay=0), [])
+        finally:
+            settings.APTREPO_BACKGROUND_REGENERATION = False
+            remove_file(repository._get_dirty_filename(self.distribution_name))
+
+    @skipRepoTestIfExcluded
+    def test_stale_metadata(self):
+        """
+        Test that the previous metadata is served while it is rebuilt in the background
+        """
+        repository = get_repository_controller(sys_user=True)
+        background_refreshes = []
+        repository._refresh_releases_data_in_background = \
+            lambda distribution_name, missing_path: background_refreshes.append(distribution_name)
+        
+        settings.APTREPO_METADATA_MAX_STALENESS = 300
+        try:
+            repository._clear_cache(self.distribution_name)
+            release_data = repository.get_release_data(self.distribution_name)
+            self.failUnlessEqual(background_refreshes, [])
+            
+            # the stale data is returned while the metadata is rebuilt
+            repository._clear_cache(self.distribution_name)
+            self.failUnlessEqual(repository.get_release_data(self.distribution_name), release_data)
+            self.failUnlessEqual(background_refreshes, [self.distribution_name])
+            
+            # stale data is not served beyond the maximum staleness
+            settings.APTREPO_METADATA_MAX_STALENESS = 1
+            repository._clear_cache(self.distribution_name)
+            time.sleep(2)
+            repository.get_release_data(self.distribution_name)
+            self.failUnlessEqual(background_refreshes, [self.distribution_name])
+        finally:
+            settings.APTREPO_METADATA_MAX_STALENESS = 0
+
+    @skipRepoTestIfExcluded
+    def test_granular_invalidation(self):
+        """
+        Test that invalidating a single architecture of a section only rebuilds its 
+        indexes and reuses the stored entries of the others
+        """
+        repository = get_repository_controller(sys_user=True)
+        release_data = repository.get_release_data(self.distribution_name)
+        index_files = models.IndexFile.objects.filter(distribution__name=self.distribution_name)
+        self.assertTrue(index_files.filter(architecture='amd64').exists())
+        
+        rebuilt_architectures = []
+        write_package_list = repository._write_package_list
+        def _write_package_list(fh, distribution, section, architecture):
+            rebuilt_architectures.append(architecture)
+            write_package_list(fh, distribution, section, architecture)
+        repository._write_package_list = _write_package_list
+        
+        repository._clear_cache(self.distribution_name, self.section_name, ['i386'])
+        index_files = index_files.filter(
+            generation=repository._get_generation(self.distribution_name))
+        self.assertFalse(index_files.filter(architecture='i386').exists())
+        self.assertTrue(index_files.filter(architecture='amd64').exists())
+        
+        self.failUnlessEqual(repository.get_release_data(self.distribution_name)[0], 
+                             release_data[0])
+        self.failUnlessEqual(rebuilt_architectures, ['i386'])
+
+    @skipRepoTestIfExcluded
+    def test_generation_invalidation(self):
+        """
+        Test that invalidation advances the generation of a distribution while the 
+        metadata of the previous generation remains consistent
+        """
+        repository = get_repository_controller(sys_user=True)
+        release_data = repository.get_release_data(self.distribution_name)
+        generation = repository._get_generation(self.distribution_name)
+        releases_path = repository._get_releases_path(self.distribution_name)
+        packages_path = repository._get_packages_path(self.distribution_name, 
+                                                      self.section_name, 'i386')
+        packages_data = repository._get_generation_metadata(self.distribution_name, 
+                                                            generation, packages_path)
+        self.assertTrue(packages_data is not None)
+        
+        repository._clear_cache(self.distribution_name)
+        self.failUnlessEqual(repository._get_generation(self.distribution_name), generation + 1)
+        self.failUnlessEqual(repository._get_generation_metadata(
+            self.distribution_name, generation, releases_path), release_data)
+        self.failUnlessEqual(repository._get_generation_metadata(
+            self.distribution_name, generation, packages_path), packages_data)
+        self.assertTrue(repository._get_generation_metadata(
+            self.distribution_name, generation + 1, releases_path) is None)
+        
+        self.failUnlessEqual(repository.get_release_data(self.distribution_name)[0], 
+                             release_data[0])
+        self._verify_repo_metadata()
+        
+        # invalidation never waits for a rebuild holding the distribution lock, and only
+        # the entries of the cleared index files are left behind in the previous generation
+        lock = FileLock(repository._get_lock_filename(self.distribution_name))
+        lock.acquire()
+        try:
+            repository._clear_cache(self.distribution_name, self.section_name, ['amd64'])
+        finally:
+            lock.release()
+        self.failUnlessEqual(repository._get_generation(self.distribution_name), generation + 2)
+        
+        distribution = models.Distribution.objects.get(name=self.distribution_name)
+        index_entries = repository._get_index_entries(distribution, generation + 2)
+        self.assertTrue(repository._get_packages_relative_path(
+            self.section_name, 'i386') in index_entries)
+        self.assertFalse(repository._get_packages_relative_path(
+            self.section_name, 'amd64') in index_entries)
+        self._verify_repo_metadata()
+
+    @skipRepoTestIfExcluded
+    def test_warm_distributions(self):
+        """
+        Test that warming a distribution builds its metadata ahead of the first request
+        """
+        repository = get_repository_controller(sys_user=True)
+        releases_path = repository._get_releases_path(self.distribution_name)
+        repository._clear_cache(self.distribution_name)
+        self.assertTrue(repository._get_generation_metadata(
+            self.distribution_name, repository._get_generation(self.distribution_name), 
+            releases_path) is None)
+        
+        timings = repository.warm_distributions([self.distribution_name], num_workers=1)
+        self.failUnlessEqual([name for (name, elapsed) in timings], [self.distribution_name])
+        self.assertTrue(repository._get_generation_metadata(
+            self.distribution_name, repository._get_generation(self.distribution_name), 
+            releases_path) is not None)
+        self._verify_repo_metadata()
+        
+        self.assertRaises(AptRepoException, repository.warm_distributions, ['nonexistent'])
+
+    @skipRepoTestIfExcluded
+    def test_resign_distributions(self):
+        """
+        Test that re-signing a distribution publishes a new signature without rebuilding 
+        its index files
+        """
+        repository = get_repository_controller(sys_user=True)
+        release_data = repository.get_release_data(self.distribution_name)
+        generation = repository._get_generation(self.distribution_name)
+        
+        rebuilt_architectures = []
+        write_package_list = repository._write_package_list
+        def _write_package_list(fh, distribution, section, architecture):
+            rebuilt_architectures.append(architecture)
+            write_package_list(fh, distribution, section, architecture)
+        repository._write_package_list = _write_package_list
+        
+        results = repository.resign_distributions([self.distribution_name], num_workers=1)
+        self.failUnlessEqual(results, [(self.distribution_name, True)])
+        self.failUnlessEqual(rebuilt_architectures, [])
+        self.failUnlessEqual(repository._get_generation(self.distribution_name), generation + 1)
+        self.failUnlessEqual(repository.get_release_data(self.distribution_name)[0], 
+                             release_data[0])
+        self._verify_repo_metadata()
+        
+        # the Release files signed with the previous key are removed when the manifest 
+        # is no longer cached
+        release_filename = os.path.join(settings.MEDIA_ROOT, 
+                                        settings.APTREPO_FILESTORE['metadata_subdir'],
+                                        self.distribution_name, 'Release.gpg')
+        settings.APTREPO_PUBLISH_METADATA = True
+        try:
+            repository._clear_cache(self.distribution_name)
+            repository.get_release_data(self.distribution_name)
+            self.assertTrue(os.path.exists(release_filename))
+            
+            repository._next_generation(self.distribution_name)
+            results = repository.resign_distributions([self.distribution_name], num_workers=1)
+            self.failUnlessEqual(results, [(self.distribution_name, False)])
+            self.assertFalse(os.path.exists(release_filename))
+        finally:
+            settings.APTREPO_PUBLISH_METADATA = False
+        
+        self.assertRaises(AuthorizationException, 
+                          get_repository_controller().resign_distributions)
+
+    @skipRepoTestIfExcluded
+    def test_gpg_signer_pool(self):
+        """
+        Test that the signers of the process-wide pool are reused across signatures
+        """
+        signer_pool = get_gpg_signer_pool()
+        self.assertTrue(signer_pool is get_gpg_signer_pool(settings.GPG_SECRET_KEY))
+        
+        with signer_pool.signer() as gpg_signer:
+            pass
+        with signer_pool.signer() as reused_gpg_signer:
+            self.assertTrue(reused_gpg_signer is gpg_signer)
+            
+        content = 'signed content'
+        self._verify_gpg_signature(content, signer_pool.sign_data(content))
+        self._verify_gpg_inline_signature(content, signer_pool.sign_data_inline(content))
+
+    @skipRepoTestIfExcluded
+    def test_signing_daemon(self):
+        """
+        Test that the Release files are signed by the signing daemon when it is configured
+        """
+        socket_dir = tempfile.mkdtemp()
+        signing_server = SigningServer(os.path.join(socket_dir, 'signer.sock'))
+        server_thread = threading.Thread(target=signing_server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        
+        settings.APTREPO_SIGNING_SOCKET = signing_server.server_address
+        try:
+            self.failUnlessEqual(stat.S_IMODE(os.stat(signing_server.server_address).st_mode),
+                                 settings.APTREPO_SIGNING_SOCKET_MODE)
+            
+            signatures = sign_releases(['first payload', 'second payload'])
+            self.failUnlessEqual(len(signatures), 2)
+            self._verify_gpg_signature('second payload', signatures[1][0])
+            self._verify_gpg_inline_signature('second payload', signatures[1][1])
+            
+            repository = get_repository_controller(sys_user=True)
+            repository._clear_cache(self.distribution_name)
+            self._verify_repo_metadata()
+        finally:
+            settings.APTREPO_SIGNING_SOCKET = None
+            signing_server.shutdown()
+            signing_server.server_close()
+            shutil.rmtree(socket_dir)
+        
+        self.assertRaises(AptRepoException, 
+                          SigningClient(signing_server.server_address).sign_releases, ['payload'])
+        
+        # a daemon which never answers fails the request once the timeout elapses
+        socket_dir = tempfile.mkdtemp()
+        unresponsive_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            socket_path = os.path.join(socket_dir, 'unresponsive.sock')
+            unresponsive_socket.bind(socket_path)
+            unresponsive_socket.listen(1)
+            self.assertRaises(AptRepoException, 
+                              SigningClient(socket_path, timeout=0.5).sign_releases, ['payload'])
+        finally:
+            unresponsive_socket.close()
+            shutil.rmtree(socket_dir)
+
+    @skipRepoTestIfExcluded
+    def test_package_file_storage(self):
+        """
+        Test that an uploaded package is stored with its hashes computed in the same pass
+        """
+        control_map = self._make_common_debcontrol()
+        control_map['Package'] = 'stored-package'
+        self._upload_new_package(control_map, 
+                                 files={'usr/share/doc/stored-package/README' : 'stored'})
+        
+        package = models.Package.objects.get(package_name=control_map['Package'])
+        with open(package.path.path, 'rb') as fh:
+            self.failUnlessEqual(package.hash_md5, hash_file_by_fh(hashlib.md5(), fh))
+            self.failUnlessEqual(package.hash_sha1, hash_file_by_fh(hashlib.sha1(), fh))
+            self.failUnlessEqual(package.hash_sha256, hash_file_by_fh(hashlib.sha256(), fh))
+        self.failUnlessEqual(package.size, os.path.getsize(package.path.path))
+        self.assertTrue(package.path.name.startswith('{0}/{1}/'.format(
+            settings.APTREPO_FILESTORE['packages_subdir'], 
+            package.hash_md5[0:settings.APTREPO_FILESTORE['hash_depth']])))
+        self.assertTrue(package.contents)
+        
+        # no partial copies are left in the store
+        packages_dir = os.path.join(settings.MEDIA_ROOT, 
+                                    settings.APTREPO_FILESTORE['packages_subdir'])
+        self.failUnlessEqual([filename for filename in os.listdir(packages_dir) 
+                              if filename.startswith('.')], [])
+
+    @skipRepoTestIfExcluded
+    def test_conditional_requests(self):
+        """
+        Test that unchanged metadata files are answered with 304 responses
+        """
+        root_distribution_url = self._ROOT_WEBDIR + '/dists/' + self.distribution_name
+        
+        # the first request builds the metadata files
+        self._download_content(root_distribution_url + '/Release')
+        for url in (root_distribution_url + '/Release', 
+                    root_distribution_url + '/InRelease',
+                    '{0}/{1}/binary-i386/Packages.gz'.format(root_distribution_url, 
+                                                            self.section_name),
+                    '{0}/{1}/binary-i386/Packages.diff/Index'.format(root_distribution_url, 
+                                                                    self.section_name),
+                    '{0}/{1}/Contents-i386.gz'.format(root_distribution_url, 
+                                                      self.section_name),
+                    self._ROOT_WEBDIR + '/dists/publickey.gpg'):
+            self._download_content(url)
+            response = self.client.get(url)
+            self.failUnlessEqual(response.status_code, 200)
+            etag = response['ETag']
+            last_modified = response['Last-Modified']
+            self.failUnlessEqual(etag, '"{0}"'.format(hashlib.sha256(response.content).hexdigest()))
+            
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.failUnlessEqual(response.status_code, 304)
+            self.failUnlessEqual(response.content, '')
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.failUnlessEqual(response.status_code, 304)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH='"outdated"')
+            self.failUnlessEqual(response.status_code, 200)
+
+    @skipRepoTestIfExcluded
+    def test_range_requests(self):
+        """
+        Test byte range requests for the streamed Packages lists and Contents indexes
+        """
+        self._upload_new_package(self._make_common_debcontrol())
+                
+        packages_url = '{0}/dists/{1}/{2}/binary-i386/Packages'.format(
+            self._ROOT_WEBDIR, self.distribution_name, self.section_name)
+        packages_content = self._download_content(packages_url)
+        size = len(packages_content)
+        
+        for (byte_range, first, last) in (('bytes=0-9', 0, 9), 
+                                          ('bytes=10-', 10, size - 1),
+                                          ('bytes=-5', size - 5, size - 1),
+                                          ('bytes=5-{0}'.format(size * 2), 5, size - 1)):
+            response = self.client.get(packages_url, HTTP_RANGE=byte_range)
+            self.failUnlessEqual(response.status_code, 206)
+            self.failUnlessEqual(response.content, packages_content[first:last + 1])
+            self.failUnlessEqual(response['Content-Range'], 
+                                 'bytes {0}-{1}/{2}'.format(first, last, size))
+            
+        response = self.client.get(packages_url, HTTP_RANGE='bytes={0}-'.format(size))
+        self.failUnlessEqual(response.status_code, 416)
+        
+        contents_url = '{0}/dists/{1}/{2}/Contents-i386.gz'.format(
+            self._ROOT_WEBDIR, self.distribution_name, self.section_name)
+        contents = self._download_content(contents_url)
+        response = self.client.get(contents_url, HTTP_RANGE='bytes=10-')
+        self.failUnlessEqual(response.status_code, 206)
+        self.failUnlessEqual(response.content, contents[10:])
+        
+        # no range of an empty list can be satisfied
+        empty_packages_url = '{0}/dists/{1}/{2}/binary-amd64/Packages'.format(
+            self._ROOT_WEBDIR, self.distribution_name, self.section_name)
+        self.failUnlessEqual(self._download_content(empty_packages_url), '')
+        for byte_range in ('bytes=-5', 'bytes=0-'):
+            response = self.client.get(empty_packages_url, HTTP_RANGE=byte_range)
+            self.failUnlessEqual(response.status_code, 416)
+            self.failUnlessEqual(response['Content-Range'], 'bytes */0')
+        
+        # ranges of an outdated copy return the whole file
+        response = self.client.get(packages_url, HTTP_RANGE='bytes=0-9', 
+                                   HTTP_IF_RANGE='"outdated"')
+        self.failUnlessEqual(response.status_code, 200)
+        self.failUnlessEqual(response.content, packages_content)
+
+    @skipRepoTestIfExcluded
+    def test_memory_cache(self):
+        """
+        Test the in-memory metadata cache in front of the shared cache
+        """
+        release_url = '{0}/dists/{1}/Release'.format(self._ROOT_WEBDIR, self.distribution_name)
+        stats_url = '{0}/cache/stats/'.format(self._ROOT_WEBDIR)
+
+        release_content = self._download_content(release_url)
+        stats = json.loads(self._download_content(stats_url))
+        self.failUnlessEqual(self._download_content(release_url), release_content)
+        new_stats = json.loads(self._download_content(stats_url))
+        self.assertTrue(new_stats['memory']['hits'] > stats['memory']['hits'])
+        self.failUnlessEqual(new_stats['shared'], stats['shared'])
+
+        # a new package advances the generation so the in-memory copy is never served
+        self._upload_new_package(self._make_common_debcontrol())
+
+        new_release_content = self._download_content(release_url)
+        self.assertNotEqual(new_release_content, release_content)
+        self._verify_repo_metadata()
+
+    def _apply_ed_diff(self, data, ed_script):
+        """
+        Applies the subset of ed commands used by PDiffs
+        """
+        lines = data.splitlines(True)
+        script = ed_script.splitlines(True)
+        i = 0
+        while i < len(script):
+            command = script[i].strip()
+            i += 1
+            line_range = [int(n) for n in command[:-1].split(',')]
+            (first, last) = (line_range[0], line_range[-1])
+            new_lines = []
+            if command[-1] in 'ac':
+                while script[i] != '.\n':
+                    new_lines.append(script[i])
+                    i += 1
+                i += 1
+                
+            if command[-1] == 'a':
+                lines[first:first] = new_lines
+            else:
+                lines[first - 1:last] = new_lines
+        
+        return ''.join(lines)
+
     @skipRepoTestIfExcluded
     def test_rest_api(self):
         """
@@ -363,6 +1097,26 @@ class LargeRepositoryTest(BaseAptRepoTest):
                 self.assertEqual(action_list[j]['action'], models.Action.UPLOAD)
                 self.assertEqual(action_list[j]['summary'], self._make_summary(package_list[j]))
 
+    @skipRepoTestIfExcluded
+    def test_package_list_queries(self):
+        """
+        Test that generating a Packages list takes a constant number of queries 
+        per chunk of packages
+        """
+        repository = get_repository_controller(sys_user=True)
+        for chunk_size in (1000, 64, self._TOTAL_PACKAGES):
+            repository._QUERY_CHUNK_SIZE = chunk_size
+            for (architecture, num_packages) in (('amd64', 0), 
+                                                 (self._DEFAULT_ARCHITECTURE, self._TOTAL_PACKAGES)):
+                packages_fh = cStringIO.StringIO()
+                self.assertNumQueries(num_packages // chunk_size + 1, 
+                                      repository._write_package_list, packages_fh, 
+                                      self.distribution_name, self.section_name, architecture)
+                
+                packages = list(deb822.Packages.iter_paragraphs(
+                    sequence=packages_fh.getvalue().splitlines()))
+                self.assertEqual(len(packages), num_packages)
+
     def test_constraints_after_deletion(self):
         """
         Remove and test ranges        
@@ -0,0 +1,114 @@
+import collections
+import threading
+import time
+
+class CacheStatistics:
+    """
+    Thread-safe hit and miss counters of a cache
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hit):
+        """
+        Records a cache lookup
+
+        hit - true if the lookup found the value
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self):
+        """
+        Returns the counters as a dictionary
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class LRUCache:
+    """
+    Thread-safe in-process cache which evicts the least recently used values once
+    the total size of its values exceeds a budget (in bytes).  Values expire after a
+    timeout like the entries of the shared cache.
+    """
+
+    def __init__(self, max_bytes, timeout=None):
+        """
+        max_bytes - maximum total size of the cached values (0 disables the cache)
+        timeout - (optional) seconds until a value expires (None never expires values)
+        """
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.size = 0
+        self.statistics = CacheStatistics()
+        self._entries = collections.OrderedDict()  # ordered from least recently used
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value of a key or None if it isn't cached (or has expired)
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                if entry[2] is not None and entry[2] <= time.time():
+                    self.size -= entry[1]
+                    entry = None
+                else:
+                    self._entries[key] = entry
+
+        self.statistics.record(entry is not None)
+        if entry:
+            return entry[0]
+        return None
+
+    def set(self, key, value, size):
+        """
+        Caches a value and evicts the least recently used values if the cache exceeds
+        its budget.  Values larger than the budget aren't cached.
+
+        size - size of the value in bytes
+        """
+        if size > self.max_bytes:
+            return
+
+        expiry = None
+        if self.timeout is not None:
+            expiry = time.time() + self.timeout
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size, expiry)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                (_, entry) = self._entries.popitem(last=False)
+                self.size -= entry[1]
+
+    def clear(self):
+        """
+        Removes all cached values
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def as_dict(self):
+        """
+        Returns the statistics and usage of the cache as a dictionary
+        """
+        stats = self.statistics.as_dict()
+        stats.update({'entries': len(self._entries), 'bytes': self.size,
+                      'max_bytes': self.max_bytes})
+        return stats
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
@@ -0,0 +1,174 @@
+import bz2
+import struct
+import zlib
+from django.utils.translation import ugettext as _
+from server.aptrepo.util import AptRepoException, constants
+
+# xz compression is optional since it requires the lzma backport
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
+
+class DigestStream:
+    """
+    In-memory output stream which computes its size and hash digests as data
+    is written
+    """
+
+    def __init__(self, hashfuncs):
+        """
+        hashfuncs - list of hashlib objects to update with the written data
+        """
+        self.hashfuncs = hashfuncs
+        self.size = 0
+        self._chunks = []
+
+    def write(self, data):
+        if not data:
+            return
+
+        self._chunks.append(data)
+        self.size += len(data)
+        for hashfunc in self.hashfuncs:
+            hashfunc.update(data)
+
+    def getvalue(self):
+        """
+        Returns all the written data as a string
+        """
+        return ''.join(self._chunks)
+
+    def hexdigests(self):
+        """
+        Returns the hexadecimal digests in the same order as the hash functions
+        """
+        return [hashfunc.hexdigest() for hashfunc in self.hashfuncs]
+
+
+class GzipCompressor:
+    """
+    Streaming gzip compressor (see RFC 1952)
+
+    The header always uses a timestamp (mtime) of 0 so that identical input
+    produces identical output
+    """
+
+    _GZIP_MAGIC = '\037\213'
+    _FLAG_FNAME = 0x08
+
+    def __init__(self, filename=None, compresslevel=9):
+        """
+        filename - (optional) original filename to store in the header
+        compresslevel - (optional) zlib compression level
+        """
+        self.filename = filename
+        self.crc = zlib.crc32('') & 0xffffffffL
+        self.size = 0
+        self._header_written = False
+        self._compressobj = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                             zlib.DEF_MEM_LEVEL, 0)
+
+    def compress(self, data):
+        """
+        Compresses a chunk of data and returns the compressed output available so far
+        """
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffffL
+        self.size += len(data)
+        return self._header() + self._compressobj.compress(data)
+
+    def flush(self):
+        """
+        Returns the remaining compressed output along with the gzip trailer
+        """
+        return self._header() + self._compressobj.flush() + \
+            struct.pack('<LL', self.crc, self.size & 0xffffffffL)
+
+    def _header(self):
+        if self._header_written:
+            return ''
+
+        self._header_written = True
+        flags = 0
+        if self.filename:
+            flags = self._FLAG_FNAME
+        header = self._GZIP_MAGIC + struct.pack('<BBLBB', zlib.DEFLATED, flags, 0, 2, 255)
+        if self.filename:
+            header += self.filename + '\000'
+        return header
+
+
+class TeeWriter:
+    """
+    File-like object which writes data to an uncompressed stream and any number of
+    compressed streams in a single pass.  The size and hash digests of every stream
+    are computed as the data is written.
+    """
+
+    def __init__(self, new_hashfuncs, compressors=()):
+        """
+        new_hashfuncs - callable returning a new list of hashlib objects for each stream
+        compressors - (optional) list of (extension, compressor) tuples where each
+                      compressor provides the compress() and flush() methods
+        """
+        self._streams = [('', None, DigestStream(new_hashfuncs()))]
+        for (extension, compressor) in compressors:
+            self._streams.append( (extension, compressor, DigestStream(new_hashfuncs())) )
+        self.closed = False
+
+    def write(self, data):
+        for (_, compressor, stream) in self._streams:
+            if compressor:
+                stream.write(compressor.compress(data))
+            else:
+                stream.write(data)
+
+    def close(self):
+        """
+        Flushes all compressed streams
+        """
+        if self.closed:
+            return
+
+        for (_, compressor, stream) in self._streams:
+            if compressor:
+                stream.write(compressor.flush())
+        self.closed = True
+
+    def streams(self):
+        """
+        Returns a list of (extension, stream) tuples starting with the uncompressed
+        stream (whose extension is empty)
+        """
+        return [(extension, stream) for (extension, _, stream) in self._streams]
+
+
+def is_compression_supported(extension):
+    """
+    Determines whether a compressed file extension is supported
+    """
+    if extension == constants.XZ_EXTENSION:
+        return lzma is not None
+    
+    return extension in (constants.GZIP_EXTENSION, constants.BZIP2_EXTENSION)
+
+
+def create_compressor(extension, compresslevel, filename=None):
+    """
+    Creates a streaming compressor for a compressed file extension
+    
+    extension - compressed file extension (e.g. '.gz')
+    compresslevel - compression level (or preset) for the compressed format
+    filename - (optional) original filename to store in the compressed header (if supported)
+    
+    Returns an object providing the compress() and flush() methods
+    """
+    if not is_compression_supported(extension):
+        raise AptRepoException(_('Unsupported compression format: {0}').format(extension))
+    
+    if extension == constants.GZIP_EXTENSION:
+        return GzipCompressor(filename, compresslevel)
+    elif extension == constants.BZIP2_EXTENSION:
+        return bz2.BZ2Compressor(compresslevel)
+    elif extension == constants.XZ_EXTENSION:
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=compresslevel)
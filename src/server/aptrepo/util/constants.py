@@ -1,4 +1,6 @@
 
 GZIP_EXTENSION = '.gz'
+BZIP2_EXTENSION = '.bz2'
+XZ_EXTENSION = '.xz'
 GPG_EXTENSION = '.gpg'
 SYSUSER_NAME = 'sysuser'
\ No newline at end of file
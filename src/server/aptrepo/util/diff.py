@@ -0,0 +1,36 @@
+import difflib
+
+def ed_diff(old_data, new_data):
+    """
+    Computes an ed-style diff (as produced by 'diff --ed') which transforms the
+    old data into the new data.  This is the patch format used by PDiffs.
+
+    old_data - original string data
+    new_data - modified string data
+
+    Returns the ed commands as a string
+    """
+    old_lines = old_data.splitlines(True)
+    new_lines = new_data.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+
+    # commands are emitted from the end of the file so that the line numbers of
+    # earlier commands remain valid when the script is applied
+    commands = []
+    for (tag, i1, i2, j1, j2) in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            continue
+
+        if tag == 'insert':
+            commands.append('{0}a\n'.format(i1))
+        else:
+            line_range = str(i1 + 1)
+            if i2 - i1 > 1:
+                line_range = '{0},{1}'.format(i1 + 1, i2)
+            commands.append(line_range + ('d\n' if tag == 'delete' else 'c\n'))
+
+        if tag != 'delete':
+            commands.extend(new_lines[j1:j2])
+            commands.append('.\n')
+
+    return ''.join(commands)
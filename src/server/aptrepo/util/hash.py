@@ -1,10 +1,17 @@
+from contextlib import contextmanager
 from django.conf import settings
+import os
+import threading
 import pyme.core
 import pyme.constants.sig
 
 # constants
 HASH_BLOCK_MULTIPLE = 128
 
+# process-wide signer pools for each secret key (see get_gpg_signer_pool)
+_gpg_signer_pools = {}
+_gpg_signer_pools_lock = threading.Lock()
+
 def hash_file_by_fh(hashfunc, fh, from_start=True):
     """
     Returns a hexadecimal hash digest for a file using a hashlib algorithm
@@ -17,6 +24,45 @@ def hash_file_by_fh(hashfunc, fh, from_start=True):
         
     return hashfunc.hexdigest()
 
+def multihash_file_by_fh(hashfuncs, fh, from_start=True):
+    """
+    Returns a list of hexadecimal hash digests for a file using several hashlib
+    algorithms while reading the file only once
+    
+    hashfuncs - list of hashlib objects
+    """
+    if from_start:
+        fh.seek(0)
+    
+    block_size = HASH_BLOCK_MULTIPLE * max(hashfunc.block_size for hashfunc in hashfuncs)
+    for chunk in iter(lambda: fh.read(block_size), ''):
+        for hashfunc in hashfuncs:
+            hashfunc.update(chunk)
+        
+    return [hashfunc.hexdigest() for hashfunc in hashfuncs]
+
+def multihash_copy_file_by_fh(hashfuncs, src_fh, dst_fh, from_start=True):
+    """
+    Copies a file while computing its hash digests with several hashlib algorithms
+    so that the file is only read once
+    
+    hashfuncs - list of hashlib objects
+    src_fh - file to copy
+    dst_fh - file to write the copy to
+    
+    Returns a list of hexadecimal hash digests for the file
+    """
+    if from_start:
+        src_fh.seek(0)
+    
+    block_size = HASH_BLOCK_MULTIPLE * max(hashfunc.block_size for hashfunc in hashfuncs)
+    for chunk in iter(lambda: src_fh.read(block_size), ''):
+        for hashfunc in hashfuncs:
+            hashfunc.update(chunk)
+        dst_fh.write(chunk)
+        
+    return [hashfunc.hexdigest() for hashfunc in hashfuncs]
+
 def hash_file(hashfunc, filename):
     """
     Returns a hexadecimal hash digest for a file using a hashlib algorithm
@@ -49,12 +95,17 @@ class GPGSigner:
         gpgme_result = self.gpg_context.op_import_result()
         pyme.errors.errorcheck(gpgme_result.imports[0].result)
         
+        # sign with (and export) the imported key rather than the default key since 
+        # the keyring may also hold previous keys once the key has been rotated
+        self.fingerprint = gpgme_result.imports[0].fpr
+        self.gpg_context.signers_add(self.gpg_context.get_key(self.fingerprint, 1))
+        
     def get_public_key(self):
         """
         Returns the GPG public key as a string
         """
         public_key_data = pyme.core.Data()
-        self.gpg_context.op_export(None, 0, public_key_data)
+        self.gpg_context.op_export(self.fingerprint, 0, public_key_data)
         public_key_data.seek(0, 0)
         return public_key_data.read()
         
@@ -64,14 +115,109 @@ class GPGSigner:
         
         data_to_sign - string data
         
-        Returns the signature as a string
+        Returns the detached signature as a string
+        """
+        return self._sign(data_to_sign, pyme.constants.sig.mode.DETACH)
+    
+    def sign_data_inline(self, data_to_sign):
+        """
+        Clear-signs arbitrary string data
+        
+        data_to_sign - string data
+        
+        Returns the data along with its inline signature as a string
         """
+        return self._sign(data_to_sign, pyme.constants.sig.mode.CLEAR)
+        
+    def _sign(self, data_to_sign, mode):
         plain_data = pyme.core.Data(data_to_sign)
         signature_data = pyme.core.Data()
-        modes = pyme.constants.sig.mode
         sign_result = self.gpg_context.op_sign(plain_data, 
                                                signature_data,
-                                               modes.DETACH)
+                                               mode)
         pyme.errors.errorcheck(sign_result)
         signature_data.seek(0, 0)
         return signature_data.read()
+
+
+class GPGSignerPool:
+    """
+    Thread-safe pool of GPG signers which are reused across signatures so that the 
+    secret key is only imported when a signer is created.  Signers are not shared 
+    with child processes.
+    """
+
+    def __init__(self, secret_key_filename=None):
+        """
+        secret_key_filename - (optional) path to secret key, defaults to settings.GPG_SECRET_KEY 
+        """
+        self.secret_key_filename = secret_key_filename
+        # modification time of the key file when the pool was created
+        self.key_mtime = None
+        self._signers = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def signer(self):
+        """
+        Context manager which provides an idle signer (see GPGSigner) for exclusive use 
+        and returns it to the pool afterwards.  A signer which raised an error is 
+        discarded.
+        """
+        gpg_signer = None
+        with self._lock:
+            if self._pid != os.getpid():
+                self._signers = []
+                self._pid = os.getpid()
+            if self._signers:
+                gpg_signer = self._signers.pop()
+        if gpg_signer is None:
+            gpg_signer = GPGSigner(self.secret_key_filename)
+            
+        yield gpg_signer
+        
+        with self._lock:
+            if self._pid == os.getpid():
+                self._signers.append(gpg_signer)
+
+    def get_public_key(self):
+        """
+        Returns the GPG public key as a string
+        """
+        with self.signer() as gpg_signer:
+            return gpg_signer.get_public_key()
+
+    def sign_data(self, data_to_sign):
+        """
+        Signs arbitrary string data (see GPGSigner.sign_data)
+        """
+        with self.signer() as gpg_signer:
+            return gpg_signer.sign_data(data_to_sign)
+
+    def sign_data_inline(self, data_to_sign):
+        """
+        Clear-signs arbitrary string data (see GPGSigner.sign_data_inline)
+        """
+        with self.signer() as gpg_signer:
+            return gpg_signer.sign_data_inline(data_to_sign)
+
+
+def get_gpg_signer_pool(secret_key_filename=None):
+    """
+    Returns the process-wide signer pool for a secret key.  A new pool is created 
+    once the key file is replaced (i.e. the key was rotated).
+    
+    secret_key_filename - (optional) path to secret key, defaults to settings.GPG_SECRET_KEY
+    """
+    if not secret_key_filename:
+        secret_key_filename = settings.GPG_SECRET_KEY
+    key_mtime = os.path.getmtime(secret_key_filename)
+        
+    with _gpg_signer_pools_lock:
+        signer_pool = _gpg_signer_pools.get(secret_key_filename)
+        if signer_pool is None or signer_pool.key_mtime != key_mtime:
+            signer_pool = GPGSignerPool(secret_key_filename)
+            signer_pool.key_mtime = key_mtime
+            _gpg_signer_pools[secret_key_filename] = signer_pool
+        return signer_pool
@@ -0,0 +1,179 @@
+import grp
+import json
+import os
+import socket
+import SocketServer
+from django.conf import settings
+from server.aptrepo.util import AptRepoException
+from server.aptrepo.util.hash import get_gpg_signer_pool
+from server.aptrepo.util.system import remove_file
+
+def sign_releases(payloads):
+    """
+    Signs a batch of Release payloads using the signing daemon if one is configured
+    (see APTREPO_SIGNING_SOCKET) or else within this process
+
+    payloads - list of strings to sign
+
+    Returns a list of (detached signature, inline signed data) tuples for each payload
+    """
+    if settings.APTREPO_SIGNING_SOCKET:
+        return SigningClient(settings.APTREPO_SIGNING_SOCKET).sign_releases(payloads)
+    return _sign_payloads(get_gpg_signer_pool(), payloads)
+
+def export_public_key():
+    """
+    Returns the GPG public key as a string using the signing daemon if one is
+    configured (see APTREPO_SIGNING_SOCKET) or else within this process
+    """
+    if settings.APTREPO_SIGNING_SOCKET:
+        return SigningClient(settings.APTREPO_SIGNING_SOCKET).get_public_key()
+    return get_gpg_signer_pool().get_public_key()
+
+def _sign_payloads(signer_pool, payloads):
+    """
+    Signs a batch of payloads with a single signer from a pool
+    """
+    with signer_pool.signer() as gpg_signer:
+        return [ (gpg_signer.sign_data(payload), gpg_signer.sign_data_inline(payload))
+                 for payload in payloads ]
+
+
+class SigningClient:
+    """
+    Client of the signing daemon (see SigningServer).  Each request is sent over a new
+    connection as a single line of JSON and answered with a single line of JSON.
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        """
+        socket_path - path of the daemon's Unix socket
+        timeout - (optional) seconds to wait for a response, defaults to 
+                  settings.APTREPO_SIGNING_TIMEOUT
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        if self.timeout is None:
+            self.timeout = settings.APTREPO_SIGNING_TIMEOUT
+
+    def sign_releases(self, payloads):
+        """
+        Signs a batch of payloads
+
+        Returns a list of (detached signature, inline signed data) tuples
+        """
+        response = self._request({'command' : 'sign', 'payloads' : payloads})
+        return [ (detached.encode('utf-8'), inline.encode('utf-8'))
+                 for (detached, inline) in response['signatures'] ]
+
+    def get_public_key(self):
+        """
+        Returns the GPG public key as a string
+        """
+        return self._request({'command' : 'public_key'})['public_key'].encode('utf-8')
+
+    def _request(self, request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock_fh = sock.makefile('rwb')
+            sock_fh.write(json.dumps(request) + '\n')
+            sock_fh.flush()
+            response_line = sock_fh.readline()
+            sock_fh.close()
+        except socket.timeout:
+            raise AptRepoException('Timed out waiting for the signing daemon at ' + 
+                                   self.socket_path)
+        except socket.error as e:
+            raise AptRepoException('Unable to reach the signing daemon at {0}: {1}'.format(
+                self.socket_path, e))
+        finally:
+            sock.close()
+
+        if not response_line:
+            raise AptRepoException('No response from the signing daemon at ' + self.socket_path)
+
+        response = json.loads(response_line)
+        if 'error' in response:
+            raise AptRepoException('Signing daemon error: ' + response['error'])
+        return response
+
+
+class SigningRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Handles a single request to the signing daemon (see SigningClient)
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            command = request.get('command')
+            # resolve the pool for each request so that a rotated key is picked up
+            signer_pool = get_gpg_signer_pool(self.server.secret_key_filename)
+            if command == 'sign':
+                payloads = [payload.encode('utf-8') for payload in request['payloads']]
+                response = {'signatures' : _sign_payloads(signer_pool, payloads)}
+            elif command == 'public_key':
+                response = {'public_key' : signer_pool.get_public_key()}
+            else:
+                response = {'error' : 'Unknown command: {0}'.format(command)}
+        except Exception as e:
+            response = {'error' : str(e)}
+
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class SigningServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Signing daemon which keeps the secret key loaded and signs requests from other
+    processes over a Unix socket whose access is restricted to its user and group 
+    (see APTREPO_SIGNING_SOCKET_MODE).  The key is reloaded once its file is replaced 
+    (i.e. the key was rotated).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, secret_key_filename=None, socket_mode=None, 
+                 socket_group=None):
+        """
+        socket_path - path of the Unix socket to listen on (replaced if it exists)
+        secret_key_filename - (optional) path to secret key, defaults to settings.GPG_SECRET_KEY
+        socket_mode - (optional) permissions of the socket, defaults to 
+                      settings.APTREPO_SIGNING_SOCKET_MODE
+        socket_group - (optional) group name of the socket, defaults to 
+                       settings.APTREPO_SIGNING_SOCKET_GROUP
+        """
+        if socket_mode is None:
+            socket_mode = settings.APTREPO_SIGNING_SOCKET_MODE
+        if socket_group is None:
+            socket_group = settings.APTREPO_SIGNING_SOCKET_GROUP
+        self.secret_key_filename = secret_key_filename
+
+        # load the key up front so that a bad key fails on startup
+        get_gpg_signer_pool(secret_key_filename).get_public_key()
+
+        # the socket is created owner-only and then opened up to its group so that it 
+        # is never accessible to other users
+        remove_file(socket_path)
+        old_umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path, SigningRequestHandler)
+        finally:
+            os.umask(old_umask)
+        
+        try:
+            if socket_group:
+                try:
+                    group_id = grp.getgrnam(socket_group).gr_gid
+                except KeyError:
+                    raise AptRepoException('Group does not exist: ' + socket_group)
+                os.chown(socket_path, -1, group_id)
+            os.chmod(socket_path, socket_mode)
+        except Exception:
+            self.server_close()
+            raise
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        remove_file(self.server_address)
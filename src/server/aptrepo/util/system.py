@@ -1,7 +1,68 @@
+import errno
+import os
 import sys
+import tempfile
 
 def get_python_version():
     """
     Retrieves the python version as a float
     """
     return sys.version_info[0] + sys.version_info[1] * 0.1 + sys.version_info[2] * 0.01
+
+def make_dirs(dirname):
+    """
+    Creates a directory along with any missing parent directories unless it exists
+    """
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another process may have created the directory concurrently
+            if not os.path.isdir(dirname):
+                raise
+
+def write_file_atomically(filename, data):
+    """
+    Writes a file so that readers either see its previous or new contents but 
+    never a partially written file.  Any missing parent directories are created.
+    """
+    dirname = os.path.dirname(filename)
+    make_dirs(dirname)
+    
+    tmp_fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(tmp_fd, 'wb') as tmp_fh:
+            tmp_fh.write(data)
+        os.chmod(tmp_filename, 0644)
+        os.rename(tmp_filename, filename)
+    except Exception:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def link_file_atomically(src_filename, dst_filename):
+    """
+    Creates a hard link to a file which replaces the destination file (if it exists) 
+    so that readers either see its previous or new contents.  Any missing parent 
+    directories are created.
+    """
+    dirname = os.path.dirname(dst_filename)
+    make_dirs(dirname)
+    
+    tmp_filename = tempfile.mktemp(dir=dirname, prefix='.' + os.path.basename(dst_filename))
+    os.link(src_filename, tmp_filename)
+    try:
+        os.rename(tmp_filename, dst_filename)
+    except Exception:
+        remove_file(tmp_filename)
+        raise
+
+def remove_file(filename):
+    """
+    Removes a file if it exists
+    """
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
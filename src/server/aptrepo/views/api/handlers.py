@@ -147,6 +147,7 @@ class DistributionHandler(BaseAptRepoHandler):
     """
     allowed_methods=('GET')
     model = server.aptrepo.models.Distribution
+    exclude = ('metadata_generation',)
 
     @handle_exception
     def read(self, request, distribution_id=None):
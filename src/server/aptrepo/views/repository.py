@@ -1,22 +1,57 @@
-import gzip
+import collections
+import cStringIO
+import datetime
+import errno
 import hashlib
 import logging
+import multiprocessing
 import os
-import shutil
-import struct
+import re
 import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 from apt_pkg import version_compare
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
-from django.db.models import Q
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import F, Q
 from django.utils.translation import ugettext as _
 from debian_bundle import deb822, debfile
 from lockfile import FileLock
+from multiprocessing.dummy import Pool as ThreadPool
 from server.aptrepo import models
 from server.aptrepo.util import AptRepoException, AuthorizationException, constants
-from server.aptrepo.util.hash import hash_file_by_fh, GPGSigner
-from server.aptrepo.util.system import get_python_version
+from server.aptrepo.util.cache import CacheStatistics, LRUCache
+from server.aptrepo.util.compression import create_compressor, is_compression_supported, TeeWriter
+from server.aptrepo.util.diff import ed_diff
+from server.aptrepo.util.hash import multihash_copy_file_by_fh, multihash_file_by_fh
+from server.aptrepo.util.signing import export_public_key, sign_releases
+from server.aptrepo.util.system import link_file_atomically, make_dirs, remove_file, \
+    write_file_atomically
+
+# compressed formats that were configured but are not supported (only logged once)
+_unsupported_compression = set()
+
+# distributions being rebuilt by a background thread of this process
+_background_refreshes = set()
+_background_refreshes_lock = threading.Lock()
+
+# serializes the updates to the generations of the by-hash directories made by the
+# metadata workers of this process (other processes are excluded by the distribution lock)
+_by_hash_lock = threading.Lock()
+
+# names of the distributions whose lock is held by each thread (see _lock_distribution)
+_held_distribution_locks = threading.local()
+
+# immutable metadata (manifests and file contents) kept in memory by this process and
+# the lookups of the shared cache behind it (values expire no later than in the shared
+# cache)
+_memory_cache = LRUCache(settings.APTREPO_MEMORY_CACHE_SIZE, cache.default_timeout)
+_shared_cache_statistics = CacheStatistics()
 
 class Repository():
     """
@@ -25,8 +60,31 @@ class Repository():
 
     _BINARYPACKAGES_PREFIX = 'binary'
     _RELEASE_FILENAME = 'Release'
+    _INLINE_RELEASE_FILENAME = 'InRelease'
     _PACKAGES_FILENAME = 'Packages'
+    _CONTENTS_PREFIX = 'Contents'
+    _SECTION_FIELD_REGEX = re.compile(r'^Section:\s*(\S+)', re.MULTILINE)
     _DEBIAN_EXTENSION = '.deb'
+    _BY_HASH_DIRNAME = 'by-hash'
+    _BY_HASH_TYPE = 'SHA256'
+    _GENERATIONS_EXTENSION = '.generations'
+    _PDIFF_EXTENSION = '.diff'
+    _PDIFF_NAME_FORMAT = '%Y-%m-%d-%H%M.%S%f' # patches are named by their UTC time
+    _PDIFF_INDEX_FILENAME = 'Index'
+    _HISTORY_EXTENSION = '.history'
+    _VALIDATORS_EXTENSION = '.validators'
+    _INVALIDATED_FILENAME = '.invalidated'
+    _MANIFEST_FILENAME = '.manifest'
+    _PUBLISHED_FILENAME = '.published'
+    _STALE_FILENAME = '.stale'
+    # by-hash files are immutable, so keep them cached well beyond the default timeout 
+    # (they are removed explicitly once their generation expires)
+    _BY_HASH_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+    _RELEASE_HASH_TYPES = ('MD5Sum', 'SHA1', 'SHA256')
+    _PACKAGE_STANZA_FIELDS = ('stanza', 'control', 'path', 'hash_md5', 'hash_sha1', 
+                              'hash_sha256', 'size')
+    # number of package instances retrieved per query when building index files
+    _QUERY_CHUNK_SIZE = 1000
     
     def __init__(self, logger=None, user=None, request=None, sys_user=False):
         """
@@ -61,34 +119,77 @@ class Repository():
             self.logger.debug('Retrieving GPG public key from cache')
             return gpg_public_key
         
-        # return the GPG public key as ASCII text
         self.logger.debug('Loading public key from the secret key and caching')
-        gpg_signer = GPGSigner()
-        gpg_public_key = gpg_signer.get_public_key()
-        
-        cache.set(cache_key, gpg_public_key)
-        return gpg_public_key
+        return self._cache_gpg_public_key()
 
     
-    def get_packages(self, distribution, section, architecture, compressed=False):
+    def get_cache_statistics(self):
+        """
+        Retrieves the hit/miss statistics of the metadata lookups made by this process
+        
+        Returns a dictionary with the statistics of the in-memory ('memory') and 
+        the shared ('shared') cache tiers
+        """
+        return {'memory': _memory_cache.as_dict(), 
+                'shared': _shared_cache_statistics.as_dict()}
+    
+    def get_metadata_validators(self, metadata_path):
+        """
+        Retrieves the validators of a cached metadata file for conditional requests
+        
+        metadata_path - path of the file relative to the metadata directory (e.g. 
+                        '<distribution>/Release')
+        
+        Returns a tuple containing the ETag (the file's SHA256 digest) and the time the
+        file was last modified (as a UTC datetime) or None if the file isn't cached
+        """
+        (distribution_name, separator, filename) = metadata_path.partition('/')
+        metadata_path = '{0}/{1}'.format(settings.APTREPO_FILESTORE['metadata_subdir'], 
+                                         metadata_path)
+        if os.path.dirname(metadata_path).endswith(self._PDIFF_EXTENSION) and \
+           filename.endswith(constants.GZIP_EXTENSION):
+            # patches never change, so their name gives their modification time
+            entry = self._get_packages_diff_entry(metadata_path)
+            if not entry:
+                return None
+            return (entry[5], datetime.datetime.strptime(entry[0], self._PDIFF_NAME_FORMAT))
+        elif separator:
+            # the files of a distribution are only valid for its current generation
+            manifest = self._get_manifest(distribution_name, 
+                                          self._get_generation(distribution_name))
+            validators = manifest and manifest['files'].get(metadata_path)
+        else:
+            validators = cache.get(self._get_validators_path(metadata_path))
+        if not validators:
+            return None
+        
+        (etag, last_modified) = validators
+        return (etag, datetime.datetime.utcfromtimestamp(last_modified))
+
+
+    def get_packages_extensions(self):
+        """
+        Returns the list of file extensions of the available Packages formats 
+        (an empty extension is used for the uncompressed format)
+        """
+        return [''] + [extension for (extension, _) in self._get_packages_compression()]
+
+
+    def get_packages(self, distribution, section, architecture, extension=''):
         """
         Retrieve the Debian 'Packages' data
         
         distribution - name of distribution
         section - name of section
         architecture - specifies the architecture subset of packages
-        compressed - (optional) if true, will compress with gzip
+        extension - (optional) extension of the compressed format to retrieve 
+                    (see get_packages_extensions)
         """
-        packages_path = self._get_packages_path(distribution, section, architecture)
-        if compressed:
-            packages_path = packages_path + constants.GZIP_EXTENSION
+        packages_path = self._get_packages_path(distribution, section, architecture) + extension
             
         self.logger.debug('Retrieving Debian Packages list at: ' + packages_path)
             
-        packages_data = cache.get(packages_path)
-        if not packages_data:
-            self._refresh_releases_data(distribution)
-            packages_data = cache.get(packages_path)
+        packages_data = self._get_cached_metadata(distribution, packages_path)
             
         # in the rare case where the cache has been cleared between refreshing
         # the data and retrieving from the cache, then just return an empty
@@ -99,25 +200,174 @@ class Repository():
         return packages_data
 
     
+    def get_packages_file(self, distribution, section, architecture, extension='', 
+                          digest=None):
+        """
+        Opens the stored file of a Debian 'Packages' list so that it can be streamed 
+        without loading it in memory.  The list's by-hash copy is opened so that its 
+        contents match the digest even if the list is rebuilt concurrently.
+        
+        distribution - name of distribution
+        section - name of section
+        architecture - specifies the architecture subset of packages
+        extension - (optional) extension of the compressed format to retrieve 
+                    (see get_packages_extensions)
+        digest - (optional) SHA256 digest of the list (i.e. its ETag), defaults to the
+                 digest listed in the manifest of the current generation
+                    
+        Returns an open file object or None if the file isn't stored (in which case 
+        get_packages must be used to rebuild it)
+        """
+        packages_path = self._get_packages_path(distribution, section, architecture) + extension
+        return self._open_index_file(distribution, packages_path, digest)
+
+    
+    def get_metadata_file_by_hash(self, distribution, directory, digest):
+        """
+        Opens the stored file of an index file (e.g. a Packages list in any format or a
+        Contents index) by its SHA256 digest so that it can be streamed without loading
+        it in memory
+
+        distribution - name of distribution
+        directory - directory of the index file relative to the distribution (i.e. 
+                    '<section>/binary-<architecture>', its 'Packages.diff' subdirectory 
+                    or '<section>')
+        digest - hexadecimal SHA256 digest of the file
+
+        Returns an open file object or None if no retained generation has this digest
+        """
+        by_hash_path = '{0}/{1}/{2}/{3}/{4}/{5}'.format(
+            settings.APTREPO_FILESTORE['metadata_subdir'], distribution, directory,
+            self._BY_HASH_DIRNAME, self._BY_HASH_TYPE, digest)
+
+        self.logger.debug('Retrieving Debian index file at: ' + by_hash_path)
+
+        try:
+            return open(self._get_metadata_filename(by_hash_path), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    
+    def get_packages_diff(self, distribution, section, architecture, filename):
+        """
+        Retrieve a file from the PDiff directory (Packages.diff) of a Packages list
+        
+        distribution - name of distribution
+        section - name of section
+        architecture - specifies the architecture subset of packages
+        filename - either 'Index' or the name of a compressed patch
+        
+        Returns the file contents or None if it doesn't exist
+        """
+        if settings.APTREPO_PDIFF_HISTORY <= 0:
+            return None
+        
+        diff_path = '{0}/{1}'.format(
+            self._get_packages_diff_dir(distribution, section, architecture), filename)
+        
+        self.logger.debug('Retrieving Debian Packages diff at: ' + diff_path)
+        
+        if filename == self._PDIFF_INDEX_FILENAME:
+            return self._get_cached_metadata(distribution, diff_path)
+        
+        # the patches are stored by hash (see _cache_package_diffs)
+        entry = self._get_packages_diff_entry(diff_path)
+        if not entry:
+            return None
+        return cache.get(self._get_by_hash_path(diff_path, entry[5]))
+
+    
+    def get_packages_diff_file(self, distribution, section, architecture, filename, 
+                               digest=None):
+        """
+        Opens the stored file of the PDiff index or of a patch of a Packages list so that
+        it can be streamed without loading it in memory (see get_packages_file)
+        
+        distribution - name of distribution
+        section - name of section
+        architecture - specifies the architecture subset of packages
+        filename - either 'Index' or the name of a compressed patch
+        digest - (optional) SHA256 digest of the index (i.e. its ETag), defaults to the
+                 digest listed in the manifest of the current generation
+        
+        Returns an open file object or None if the file isn't stored (in which case 
+        get_packages_diff must be used to rebuild it)
+        """
+        if settings.APTREPO_PDIFF_HISTORY <= 0:
+            return None
+        
+        diff_path = '{0}/{1}'.format(
+            self._get_packages_diff_dir(distribution, section, architecture), filename)
+        if filename == self._PDIFF_INDEX_FILENAME:
+            return self._open_index_file(distribution, diff_path, digest)
+        
+        entry = self._get_packages_diff_entry(diff_path)
+        if not entry:
+            return None
+        return self._open_index_file(distribution, diff_path, entry[5])
+
+    
+    def get_contents(self, distribution, section, architecture):
+        """
+        Retrieve the compressed Debian 'Contents' index of a section
+        
+        distribution - name of distribution
+        section - name of section
+        architecture - specifies the architecture subset of packages
+        
+        Returns the gzipped index or None if Contents indexes are disabled
+        """
+        if not settings.APTREPO_CONTENTS_INDEXES:
+            return None
+        
+        contents_path = self._get_contents_path(distribution, section, architecture)
+        
+        self.logger.debug('Retrieving Debian Contents index at: ' + contents_path)
+        
+        return self._get_cached_metadata(distribution, contents_path)
+
+    
+    def get_contents_file(self, distribution, section, architecture, digest=None):
+        """
+        Opens the stored file of the compressed Debian 'Contents' index of a section so
+        that it can be streamed without loading it in memory (see get_packages_file)
+        
+        distribution - name of distribution
+        section - name of section
+        architecture - specifies the architecture subset of packages
+        digest - (optional) SHA256 digest of the index (i.e. its ETag), defaults to the
+                 digest listed in the manifest of the current generation
+        
+        Returns an open file object or None if the file isn't stored (in which case 
+        get_contents must be used to rebuild it)
+        """
+        if not settings.APTREPO_CONTENTS_INDEXES:
+            return None
+        
+        contents_path = self._get_contents_path(distribution, section, architecture)
+        return self._open_index_file(distribution, contents_path, digest)
+
+    
     def get_release_data(self, distribution):
         """
         Retrieve the Debian 'Release' data
         
         distribution - name of distribution
+        
+        Returns a tuple containing the Release data, its detached signature and the 
+        inline signed Release data (InRelease)
         """
         releases_path = self._get_releases_path(distribution)
         
         self.logger.debug('Retrieving Debian Releases list at: ' + releases_path)
         
-        releases_data = None
-        releases_signature = None
-        cached_data = cache.get(releases_path)
+        cached_data = self._get_cached_metadata(distribution, releases_path)
         if not cached_data:
-            (releases_data, releases_signature) = self._refresh_releases_data(distribution)
-        else:
-            (releases_data, releases_signature) = cached_data
+            cached_data = self._refresh_releases_data(distribution)
             
-        return (releases_data, releases_signature)            
+        return cached_data
         
 
     def add_package(self, **kwargs):
@@ -191,18 +441,18 @@ class Repository():
                 _('Invalid architecture for distribution ({dist}) : {arch}').format(
                     dist=distribution.name, arch=control['Architecture']))
 
-        # compute hashes
-        hashes = {}
-        hashes['md5'] = hash_file_by_fh(hashlib.md5(), package_fh)
-        hashes['sha1'] = hash_file_by_fh(hashlib.sha1(), package_fh)
-        hashes['sha256'] = hash_file_by_fh(hashlib.sha256(), package_fh)
-
-        # create a new package entry or verify its hashes if it already exists
+        # an existing package only requires its hashes to be verified, otherwise the file
+        # is copied into the store while its hashes are computed so that it is only read
+        # once (see _store_package_file)
         package_search = models.Package.objects.filter(package_name=control['Package'],
                                                        version=control['Version'],
                                                        architecture=control['Architecture'])
+        hashes = {}
+        hashfuncs = (hashlib.md5(), hashlib.sha1(), hashlib.sha256())
         if package_search.count() > 0:
             package = package_search[0]
+            (hashes['md5'], hashes['sha1'], hashes['sha256']) = multihash_file_by_fh(
+                hashfuncs, package_fh)
             if package.hash_md5 != hashes['md5'] or \
                package.hash_sha1 != hashes['sha1'] or \
                package.hash_sha256 != hashes['sha256']:
@@ -212,25 +462,23 @@ class Repository():
         else:
             package = models.Package()
             try:
-                package.size = package_size
-                package.hash_md5 = hashes['md5']
-                package.hash_sha1 = hashes['sha1']
-                package.hash_sha256 = hashes['sha256']
-    
                 package.architecture = control['Architecture']
                 package.package_name = control['Package']
                 package.version = control['Version']
                 package.control = control.dump()
                 
-                hash_prefix = hashes['md5'][0:settings.APTREPO_FILESTORE['hash_depth']]
-                stored_file_path = os.path.join(
-                    settings.APTREPO_FILESTORE['packages_subdir'],
-                    hash_prefix, 
-                    '{0}_{1}_{2}{3}'.format(control['Package'], 
-                                            control['Version'], 
-                                            control['Architecture'],
-                                            self._DEBIAN_EXTENSION))
-                package.path.save(stored_file_path, package_fh) 
+                self._store_package_file(package, package_fh, package_size, hashfuncs)
+                
+                # the file list is read from the data archive while it is still in the 
+                # page cache (a package whose files can't be listed is still added with 
+                # an empty file list and is left out of the Contents indexes)
+                try:
+                    package.contents = self._list_package_files(deb)
+                except Exception as e:
+                    self.logger.warning('Unable to list the files of {0}: {1}'.format(
+                        package_name, e))
+                    package.contents = ''
+                package.stanza = self._render_package_stanza(package)
                 
                 package.save()
 
@@ -241,8 +489,8 @@ class Repository():
 
         # create a package instance
         self.logger.debug('Creating new package instance for ' + str(package))        
-        package_instance = models.PackageInstance.objects.get_or_create(
-            package=package, section=section, creator=self._get_username())[0]
+        (package_instance, created) = models.PackageInstance.objects.get_or_create(
+            package=package, section=section, creator=self._get_username())
         
         # record an upload action
         summary = _('{creator} added package {package}').format(creator=package_instance.creator,
@@ -253,8 +501,9 @@ class Repository():
                             package=package,
                             comment=kwargs.get('comment'))
         
-        # invalidate the cache and return the new instance ID
-        self._clear_cache(distribution.name)
+        # update the cached metadata and return the new instance ID
+        if created:
+            self._update_package_lists(section, package)
         return package_instance.id
 
         
@@ -344,7 +593,7 @@ class Repository():
                             package=src_package,
                             comment=comment)
         
-        self._clear_cache(dest_section.distribution.name)
+        self._update_package_lists(dest_section, src_package)
         return package_instance.id
 
         
@@ -373,7 +622,7 @@ class Repository():
             package.delete()
         
         # update for the package list for the specific section and architecture
-        self._clear_cache(section.distribution.name)
+        self._update_package_lists(section, package, removed=True)
         
         # insert action for removal
         summary = _('{user} removed package {package} from {section}').format(
@@ -441,7 +690,7 @@ class Repository():
         """
         total_instances_pruned = 0
         total_actions_pruned = 0
-        pruned_distribution_names = set()
+        pruned_sections = set()
         for section_id in section_id_list:
             
             # skip the section if it doesn't require pruning
@@ -527,7 +776,7 @@ class Repository():
             # any aggregate measures
             summary = '{0} instances pruned from section {1}'.format(num_instances_pruned, section) 
             if num_instances_pruned > 0:
-                pruned_distribution_names.add(section.distribution.name)
+                pruned_sections.add( (section.distribution.name, section.name) )
                 total_instances_pruned += num_instances_pruned
                 self._record_action(models.Action.PRUNE, section, summary)
 
@@ -573,8 +822,8 @@ class Repository():
             total_packages_pruned += 1
         
         # clear caches
-        for distribution_name in pruned_distribution_names:
-            self._clear_cache(distribution_name)
+        for (distribution_name, section_name) in pruned_sections:
+            self._invalidate_metadata(distribution_name, section_name)
         
         # log and return pruning summary
         self.logger.info('Total actions pruned: %d', total_actions_pruned)
@@ -583,6 +832,255 @@ class Repository():
         return (total_instances_pruned, total_packages_pruned, total_actions_pruned)
             
     
+    def regenerate_dirty_distributions(self, delay=None, max_delay=None):
+        """
+        Rebuilds the metadata of each distribution which was invalidated while background
+        regeneration is enabled (see APTREPO_BACKGROUND_REGENERATION).  Invalidations
+        are coalesced so that a distribution is only rebuilt once it has had no further
+        invalidations for the delay or has been waiting for the maximum delay.
+        
+        delay - (optional) debounce delay in seconds (defaults to APTREPO_REGENERATION_DELAY)
+        max_delay - (optional) maximum delay in seconds (defaults to 
+                    APTREPO_REGENERATION_MAX_DELAY)
+        
+        Returns the list of regenerated distribution names (distributions which failed to 
+        be rebuilt remain dirty)
+        """
+        if delay is None:
+            delay = settings.APTREPO_REGENERATION_DELAY
+        if max_delay is None:
+            max_delay = settings.APTREPO_REGENERATION_MAX_DELAY
+            
+        regenerated_distributions = []
+        for distribution_name in models.Distribution.objects.values_list('name', flat=True):
+            invalidation_times = self._get_invalidation_times(distribution_name)
+            if not invalidation_times:
+                continue
+            
+            (first_invalidated, last_invalidated) = invalidation_times
+            now = time.time()
+            if now - last_invalidated < delay and now - first_invalidated < max_delay:
+                continue
+            
+            # a failed rebuild is logged and the distribution is kept dirty so that it is
+            # retried on the next pass without holding up the other distributions
+            self.logger.info('Regenerating metadata for distribution: ' + distribution_name)
+            try:
+                self._refresh_releases_data(distribution_name, rebuild_all=True)
+            except Exception as e:
+                self.logger.exception(e)
+                continue
+            regenerated_distributions.append(distribution_name)
+            
+            # invalidations which occurred during the rebuild keep the distribution dirty
+            invalidation_times = self._get_invalidation_times(distribution_name)
+            if invalidation_times and invalidation_times[1] == last_invalidated:
+                remove_file(self._get_dirty_filename(distribution_name))
+
+        return regenerated_distributions
+
+
+    def warm_distributions(self, distribution_names=None, rebuild_all=False, num_workers=None):
+        """
+        Builds and signs the metadata of distributions ahead of the first request (e.g.
+        after a deploy or once the cache was cleared).  Distributions are warmed
+        concurrently by a pool of workers.
+
+        distribution_names - (optional) list of distributions to warm (defaults to all)
+        rebuild_all - (optional) if true, the index files which are still cached are
+                      rebuilt as well
+        num_workers - (optional) number of distributions to warm concurrently (defaults
+                      to APTREPO_METADATA_WORKERS)
+
+        Returns a list of (distribution name, seconds elapsed) tuples in the order of
+        the distribution names
+        """
+        self.get_gpg_public_key()
+
+        def warm(distribution_name):
+            start_time = time.time()
+            self.logger.info('Warming metadata for distribution: ' + distribution_name)
+            self._refresh_releases_data(distribution_name, rebuild_all=rebuild_all)
+            return (distribution_name, time.time() - start_time)
+
+        return self._map_distributions(warm, distribution_names, num_workers)
+
+
+    def resign_distributions(self, distribution_names=None, num_workers=None):
+        """
+        Re-signs the current Release data of distributions with the secret key (e.g. 
+        after GPG_SECRET_KEY was rotated) and publishes its public key.  The index files 
+        are not rebuilt.  The metadata of distributions without a cached manifest is 
+        cleared instead, which removes their Release files signed with the previous key,
+        so that it is signed with the new key once it is rebuilt.
+        
+        distribution_names - (optional) list of distributions to re-sign (defaults to all)
+        num_workers - (optional) number of distributions to re-sign concurrently (defaults
+                      to APTREPO_METADATA_WORKERS)
+        
+        Returns a list of (distribution name, re-signed) tuples in the order of the
+        distribution names
+        """
+        if not self.sys_user:
+            raise AuthorizationException()
+        
+        self._cache_gpg_public_key()
+        
+        def get_release(distribution_name):
+            generation = self._get_generation(distribution_name)
+            return (distribution_name, generation, 
+                    self._get_manifest(distribution_name, generation))
+        
+        releases = [ release for release in self._map_distributions(
+                        get_release, distribution_names, num_workers) if release[2] ]
+        
+        # sign the Release data of every distribution in a single batch
+        signatures = {}
+        if releases:
+            release_signatures = sign_releases(
+                [manifest['release'][0] for (_, _, manifest) in releases])
+            for ((distribution_name, generation, _), release_signature) in \
+                zip(releases, release_signatures):
+                signatures[distribution_name] = (generation, release_signature)
+        
+        def resign(distribution_name):
+            if distribution_name not in signatures:
+                self._clear_cache(distribution_name)
+                return (distribution_name, False)
+            
+            with self._lock_distribution(distribution_name):
+                generation = self._get_generation(distribution_name)
+                manifest = self._get_manifest(distribution_name, generation)
+                if manifest is None:
+                    self._clear_cache(distribution_name)
+                    return (distribution_name, False)
+                
+                # the distribution was rebuilt since the batch was signed, so its current 
+                # Release data is signed on its own
+                (signed_generation, release_signature) = signatures[distribution_name]
+                if signed_generation != generation:
+                    release_signature = None
+                
+                self.logger.info('Re-signing Release for distribution: ' + distribution_name)
+                release_paths = self._get_release_paths(distribution_name)
+                index_digests = dict( (metadata_path, validators[0]) 
+                                      for (metadata_path, validators) in manifest['files'].items()
+                                      if metadata_path not in release_paths )
+                self._publish_release(distribution_name, generation, manifest['release'][0], 
+                                      index_digests, release_signature)
+                return (distribution_name, True)
+        
+        return self._map_distributions(resign, distribution_names, num_workers)
+
+
+    def _cache_gpg_public_key(self):
+        """
+        Exports the GPG public key of the secret key, caches it and writes it to disk
+        
+        Returns the public key as ASCII text
+        """
+        cache_key = settings.APTREPO_FILESTORE['gpg_publickey']
+        gpg_public_key = export_public_key()
+        
+        cache.set(cache_key, gpg_public_key)
+        public_key_path = '{0}/{1}'.format(settings.APTREPO_FILESTORE['metadata_subdir'], 
+                                           cache_key)
+        self._cache_validators(public_key_path, gpg_public_key)
+        self._publish_metadata(public_key_path, gpg_public_key)
+        return gpg_public_key
+
+
+    def _map_distributions(self, func, distribution_names=None, num_workers=None):
+        """
+        Calls a function for each distribution using a pool of worker threads
+        
+        func - function which is passed the name of a distribution
+        distribution_names - (optional) list of distribution names (defaults to all)
+        num_workers - (optional) number of concurrent calls (defaults to 
+                      APTREPO_METADATA_WORKERS)
+                      
+        Returns the list of results in the order of the distribution names
+        """
+        if distribution_names is None:
+            distribution_names = list(models.Distribution.objects.values_list(
+                'name', flat=True).order_by('name'))
+        else:
+            for distribution_name in distribution_names:
+                if not models.Distribution.objects.filter(name=distribution_name).exists():
+                    raise AptRepoException(
+                        'Distribution does not exist: {0}'.format(distribution_name))
+
+        if num_workers is None:
+            num_workers = self._get_metadata_workers()
+        if num_workers == 1:
+            return [func(distribution_name) for distribution_name in distribution_names]
+
+        def call_in_worker(distribution_name):
+            try:
+                return func(distribution_name)
+            finally:
+                # each worker thread has its own database connection
+                connection.close()
+
+        pool = ThreadPool(min(num_workers, max(len(distribution_names), 1)))
+        try:
+            return pool.map(call_in_worker, distribution_names)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def _store_package_file(self, package, package_fh, package_size, hashfuncs):
+        """
+        Copies a package file into the store while computing its hashes in the same
+        pass and sets the package's path, size and hashes.  Since the stored path 
+        depends on the MD5 hash, the file is copied next to its final location and 
+        linked to it once the copy is complete (the link fails rather than replacing a 
+        file stored concurrently under the same name).
+        
+        package - new package model object (with its name, version and architecture)
+        package_fh - file object of the package
+        package_size - size of the package file
+        hashfuncs - MD5, SHA1 and SHA256 hashlib objects
+        """
+        packages_dir = default_storage.path(settings.APTREPO_FILESTORE['packages_subdir'])
+        make_dirs(packages_dir)
+        
+        tmp_fd, tmp_filename = tempfile.mkstemp(dir=packages_dir, prefix='.',
+                                                suffix=self._DEBIAN_EXTENSION)
+        try:
+            with os.fdopen(tmp_fd, 'wb') as tmp_fh:
+                (package.hash_md5, package.hash_sha1, package.hash_sha256) = \
+                    multihash_copy_file_by_fh(hashfuncs, package_fh, tmp_fh)
+            package.size = package_size
+            
+            if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                os.chmod(tmp_filename, settings.FILE_UPLOAD_PERMISSIONS)
+            
+            hash_prefix = package.hash_md5[0:settings.APTREPO_FILESTORE['hash_depth']]
+            while True:
+                stored_file_path = default_storage.get_available_name(os.path.join(
+                    settings.APTREPO_FILESTORE['packages_subdir'],
+                    hash_prefix, 
+                    '{0}_{1}_{2}{3}'.format(package.package_name, 
+                                            package.version, 
+                                            package.architecture,
+                                            self._DEBIAN_EXTENSION)))
+                stored_filename = default_storage.path(stored_file_path)
+                make_dirs(os.path.dirname(stored_filename))
+                try:
+                    os.link(tmp_filename, stored_filename)
+                    break
+                except OSError as e:
+                    # another upload claimed the name first
+                    if e.errno != errno.EEXIST:
+                        raise
+            package.path.name = stored_file_path
+            
+        finally:
+            remove_file(tmp_filename)
+
+
     def _write_package_list(self, fh, distribution, section, architecture):
         """
         Writes a package list for a repository section
@@ -594,26 +1092,608 @@ class Repository():
             )
         )
         
-        package_instances = models.PackageInstance.objects.filter(
+        # retrieve the package fields in chunks so that memory use doesn't grow with 
+        # the size of the section
+        package_instances = self._get_index_package_instances(distribution, section, 
+                                                               architecture)
+        package_rows = self._iterate_in_chunks(
+            package_instances, ['package__' + field for field in self._PACKAGE_STANZA_FIELDS])
+        for row in package_rows:
+            stanza = row[0]
+            if stanza:
+                fh.write(stanza.encode('utf-8'))
+            else:
+                package = models.Package(**dict(zip(self._PACKAGE_STANZA_FIELDS, row)))
+                fh.write(self._get_package_stanza(package))
+
+
+    def _iterate_in_chunks(self, queryset, fields):
+        """
+        Iterates over the values of a queryset ordered by id, retrieving at most 
+        _QUERY_CHUNK_SIZE rows per query.  Each query resumes after the last id of the 
+        previous chunk (database cursors don't reliably stream large results).
+        
+        queryset - queryset to iterate over
+        fields - list of the fields to retrieve
+        
+        Yields a tuple of the field values for each row
+        """
+        queryset = queryset.order_by('id')
+        last_id = None
+        while True:
+            chunk_queryset = queryset
+            if last_id is not None:
+                chunk_queryset = queryset.filter(id__gt=last_id)
+            rows = list(chunk_queryset.values_list('id', *fields)[:self._QUERY_CHUNK_SIZE])
+            for row in rows:
+                yield row[1:]
+                
+            if len(rows) < self._QUERY_CHUNK_SIZE:
+                return
+            last_id = rows[-1][0]
+
+
+    def _get_index_package_instances(self, distribution, section, architecture):
+        """
+        Returns the package instances listed in the index files of an architecture 
+        within a section.  Architecture independent packages are included unless they 
+        are published separately (see APTREPO_SEPARATE_ARCHITECTURE_ALL).
+        """
+        architecture_filter = Q(package__architecture=architecture)
+        if architecture != models.Architecture.ARCHITECTURE_ALL and \
+           not settings.APTREPO_SEPARATE_ARCHITECTURE_ALL:
+            architecture_filter |= Q(package__architecture=models.Architecture.ARCHITECTURE_ALL)
+            
+        return models.PackageInstance.objects.filter(
             Q(section__distribution__name=distribution),
             Q(section__name=section),
-            Q(package__architecture=architecture) | 
-            Q(package__architecture=models.Architecture.ARCHITECTURE_ALL))
-        for instance in package_instances:
-            control_data = deb822.Deb822(sequence=instance.package.control)
-            control_data['Filename'] = instance.package.path.name
-            control_data['MD5sum'] = instance.package.hash_md5
-            control_data['SHA1'] = instance.package.hash_sha1
-            control_data['SHA256'] = instance.package.hash_sha256
-            control_data['Size'] = str(instance.package.size)
-            
-            control_data.dump(fh)
-            fh.write('\n')
+            architecture_filter)
+
+
+    def _write_contents_list(self, fh, distribution, section, architecture):
+        """
+        Writes the Contents index of a repository section from the file lists stored
+        for its packages.  Each line maps a file to the packages that contain it.
+        """
+
+        self.logger.debug(
+            'Rebuilding Debian Contents index for {0}:{1}:{2}'.format(
+                distribution, section, architecture
+            )
+        )
+        
+        package_instances = self._get_index_package_instances(distribution, section, 
+                                                               architecture)
+        package_rows = self._iterate_in_chunks(
+            package_instances, 
+            ['package__id', 'package__package_name', 'package__control', 'package__contents'])
+        
+        file_locations = {}
+        for (package_id, package_name, control, contents) in package_rows:
+            if contents is None:
+                contents = self._capture_package_contents(package_id)
+            
+            location = self._get_contents_location(package_name, control)
+            for filename in contents.splitlines():
+                file_locations.setdefault(filename, set()).add(location)
+                
+        self._render_contents_list(fh, file_locations)
+
+
+    def _update_contents_list(self, contents_data, distribution, section, architecture, 
+                              package, removed=False):
+        """
+        Applies a single package change as a delta to a Contents index (see 
+        _write_contents_list)
+        
+        contents_data - the gzipped Contents index
+        package - package model object that was added or removed
+        removed - (optional) if true, the package was removed from the section
+        
+        Returns the updated Contents index (uncompressed)
+        """
+        file_locations = {}
+        for line in zlib.decompress(contents_data, 16 + zlib.MAX_WBITS).splitlines():
+            (filename, locations) = line.decode('utf-8').rsplit('\t', 1)
+            file_locations[filename] = set(locations.split(','))
+        
+        contents = package.contents
+        if contents is None and not removed:
+            contents = self._capture_package_contents(package.id)
+        filenames = contents.splitlines() if contents else []
+        location = self._get_contents_location(package.package_name, package.control)
+        
+        if removed:
+            # the files of the remaining instances of the package (the removed instance 
+            # was already deleted) and of its other versions remain at the same location 
+            retained_filenames = set()
+            other_packages = self._get_index_package_instances(
+                distribution, section, architecture).filter(
+                package__package_name=package.package_name).values_list(
+                'package__id', 'package__control', 'package__contents')
+            for (package_id, control, other_contents) in other_packages:
+                if self._get_contents_location(package.package_name, control) != location:
+                    continue
+                if other_contents is None:
+                    other_contents = self._capture_package_contents(package_id)
+                if other_contents:
+                    retained_filenames.update(other_contents.splitlines())
+                    
+            for filename in filenames:
+                locations = file_locations.get(filename)
+                if filename in retained_filenames or not locations:
+                    continue
+                locations.discard(location)
+                if not locations:
+                    del file_locations[filename]
+        else:
+            for filename in filenames:
+                file_locations.setdefault(filename, set()).add(location)
+        
+        contents_fh = cStringIO.StringIO()
+        self._render_contents_list(contents_fh, file_locations)
+        return contents_fh.getvalue()
+
+
+    def _render_contents_list(self, fh, file_locations):
+        """
+        Writes the lines of a Contents index sorted by filename
+        
+        file_locations - dictionary mapping each filename to the set of its locations
+        """
+        for filename in sorted(file_locations.keys()):
+            fh.write(u'{0}\t{1}\n'.format(
+                filename, ','.join(sorted(file_locations[filename]))).encode('utf-8'))
+
+
+    def _get_contents_location(self, package_name, control):
+        """
+        Returns the location of a package in the Contents indexes, which is qualified by
+        the package's section (e.g. 'utils/less')
+        """
+        section_match = self._SECTION_FIELD_REGEX.search(control)
+        if section_match:
+            return '{0}/{1}'.format(section_match.group(1), package_name)
+        return package_name
+
+
+    def _list_package_files(self, deb):
+        """
+        Returns the sorted, newline separated list of the files (excluding directories) 
+        in the data member of a Debian package as a unicode string
+        
+        deb - DebFile object for the package
+        """
+        filenames = []
+        for member in deb.data.tgz():
+            if not member.isdir():
+                filename = os.path.normpath(member.name).lstrip('/')
+                filenames.append(filename.decode('utf-8', 'replace'))
+                
+        return '\n'.join(sorted(filenames))
+        
+
+    def _capture_package_contents(self, package_id):
+        """
+        Stores the file list of a package which was uploaded before file lists were 
+        captured, and returns it
+        
+        Returns the file list, which is empty if the package file is missing or 
+        unreadable so that each package file is only examined once
+        """
+        package = models.Package.objects.get(pk=package_id)
+        try:
+            deb = debfile.DebFile(filename=package.path.path)
+            contents = self._list_package_files(deb)
+        except Exception as e:
+            self.logger.warning('Unable to list the files of {0}: {1}'.format(package, e))
+            contents = ''
+        
+        models.Package.objects.filter(pk=package_id).update(contents=contents)
+        return contents
+
+
+    def _get_package_stanza(self, package):
+        """
+        Returns the Packages list entry (stanza) for a package as a UTF-8 encoded 
+        string, rendering it if it wasn't stored when the package was uploaded
+        """
+        stanza = package.stanza
+        if not stanza:
+            stanza = self._render_package_stanza(package)
+        
+        if isinstance(stanza, unicode):
+            stanza = stanza.encode('utf-8')
+        return stanza
+
+
+    def _render_package_stanza(self, package):
+        """
+        Returns the Packages list entry (stanza) for a package
+        """
+        control_data = deb822.Deb822(sequence=package.control)
+        control_data['Filename'] = package.path.name
+        control_data['MD5sum'] = package.hash_md5
+        control_data['SHA1'] = package.hash_sha1
+        control_data['SHA256'] = package.hash_sha256
+        control_data['Size'] = str(package.size)
+        
+        return control_data.dump() + '\n'
+
+
+    def _create_packages_writer(self):
+        """
+        Returns a writer which compresses and hashes a Packages list into every format
+        in a single pass as it is written (see _cache_package_list)
+        """
+        compressors = []
+        for (extension, compresslevel) in self._get_packages_compression():
+            compressors.append( 
+                (extension, create_compressor(extension, compresslevel, self._PACKAGES_FILENAME)) )
+        return TeeWriter(self._new_release_hashfuncs, compressors)
+
+
+    def _cache_package_list(self, distribution_name, section, architecture, index_writer):
+        """
+        Caches a Packages list in every format
+        
+        index_writer - writer the Packages list was written to (see _create_packages_writer)
+        
+        Returns a dictionary mapping the relative paths of the Packages files to their 
+        (size, md5, sha1, sha256) index entries
+        """
+        index_writer.close()
+
+        packages_path = self._get_packages_path(distribution_name, section, architecture)
+        rel_packages_path = self._get_packages_relative_path(section, architecture)
+        by_hash_index = self._RELEASE_HASH_TYPES.index(self._BY_HASH_TYPE)
+        index_entries = {}
+        by_hash_digests = []
+        packages_data = None
+        for (extension, stream) in index_writer.streams():
+            digests = stream.hexdigests()
+            data = stream.getvalue()
+            if not extension:
+                packages_data = data
+            self._store_metadata(packages_path + extension, data, digests[by_hash_index])
+            index_entries[rel_packages_path + extension] = (stream.size,) + tuple(digests)
+            by_hash_digests.append(digests[by_hash_index])
+
+        # the previous generation of the uncompressed list is retrieved from the by-hash
+        # files before they are expired
+        if settings.APTREPO_PDIFF_HISTORY > 0:
+            old_packages_data = self._get_previous_by_hash(packages_path)
+            index_entries.update(
+                self._cache_package_diffs(distribution_name, section, architecture,
+                                          old_packages_data, packages_data))
+
+        self._store_by_hash(packages_path, by_hash_digests)
+            
+        return index_entries
+
+
+    def _cache_contents_list(self, distribution_name, section, architecture, contents_data):
+        """
+        Compresses and caches a Contents index
+        
+        contents_data - string containing the uncompressed Contents index
+        
+        Returns a dictionary mapping the relative path of the Contents index to its
+        (size, md5, sha1, sha256) index entry
+        """
+        compressor = create_compressor(constants.GZIP_EXTENSION, 9)
+        contents_writer = TeeWriter(self._new_release_hashfuncs, 
+                                    [(constants.GZIP_EXTENSION, compressor)])
+        contents_writer.write(contents_data)
+        contents_writer.close()
+        
+        (_, stream) = contents_writer.streams()[1]
+        digests = stream.hexdigests()
+        contents_path = self._get_contents_path(distribution_name, section, architecture)
+        digest = digests[self._RELEASE_HASH_TYPES.index(self._BY_HASH_TYPE)]
+        self._store_metadata(contents_path, stream.getvalue(), digest)
+        self._store_by_hash(contents_path, [digest])
+        
+        rel_contents_path = self._get_contents_relative_path(section, architecture)
+        return { rel_contents_path : (stream.size,) + tuple(digests) }
+
+
+    def _cache_package_diffs(self, distribution_name, section, architecture, 
+                             old_packages_data, packages_data):
+        """
+        Adds a patch between the previous and current Packages list to its PDiff 
+        history and caches the updated Packages.diff/Index
+        
+        old_packages_data - previous uncompressed Packages list (None if unknown)
+        packages_data - current uncompressed Packages list
+        
+        Returns a dictionary mapping the relative path of the PDiff index to its 
+        (size, md5, sha1, sha256) index entry
+        """
+        diff_dir = self._get_packages_diff_dir(distribution_name, section, architecture)
+        history_path = '{0}/{1}{2}'.format(diff_dir, self._PDIFF_INDEX_FILENAME, 
+                                          self._HISTORY_EXTENSION)
+        
+        # each history entry is a tuple of (patch name, the old list's sha256 and size, 
+        # the patch's sha256 and size, the compressed patch's sha256 and size)
+        history = cache.get(history_path) or []
+        expired_history = []
+        if old_packages_data is None:
+            # the chain of patches is broken without the previous list
+            expired_history = history
+            history = []
+        elif old_packages_data != packages_data:
+            patch_data = ed_diff(old_packages_data, packages_data)
+            compressor = create_compressor(constants.GZIP_EXTENSION, 9)
+            compressed_patch_data = compressor.compress(patch_data) + compressor.flush()
+            
+            patch_name = datetime.datetime.utcnow().strftime(self._PDIFF_NAME_FORMAT)
+            patch_path = '{0}/{1}{2}'.format(diff_dir, patch_name, constants.GZIP_EXTENSION)
+            compressed_patch_digest = hashlib.sha256(compressed_patch_data).hexdigest()
+            self._store_metadata(patch_path, compressed_patch_data, compressed_patch_digest)
+            self._publish_metadata(patch_path, compressed_patch_data)
+            
+            history.append( (patch_name, 
+                             hashlib.sha256(old_packages_data).hexdigest(), len(old_packages_data),
+                             hashlib.sha256(patch_data).hexdigest(), len(patch_data),
+                             compressed_patch_digest, len(compressed_patch_data)) )
+            
+            expired_history = history[:-settings.APTREPO_PDIFF_HISTORY]
+            history = history[-settings.APTREPO_PDIFF_HISTORY:]
+            
+        if expired_history:
+            # patches are never shared by generations so they are expired with the history
+            expired_paths = []
+            for entry in expired_history:
+                patch_path = '{0}/{1}{2}'.format(diff_dir, entry[0], constants.GZIP_EXTENSION)
+                expired_paths.extend([patch_path, self._get_by_hash_path(patch_path, entry[5])])
+            self._unpublish_metadata(expired_paths)
+            cache.delete_many(expired_paths)
+        cache.set(history_path, history, self._BY_HASH_CACHE_TIMEOUT)
+        
+        # render the index in the format expected by apt
+        diff_index = ['SHA256-Current: {0} {1}'.format(
+            hashlib.sha256(packages_data).hexdigest(), len(packages_data))]
+        for (field, offset, extension) in (('SHA256-History', 1, ''), 
+                                           ('SHA256-Patches', 3, ''), 
+                                           ('SHA256-Download', 5, constants.GZIP_EXTENSION)):
+            diff_index.append(field + ':')
+            for entry in history:
+                diff_index.append(' {0} {1} {2}{3}'.format(
+                    entry[offset], entry[offset + 1], entry[0], extension))
+        diff_index_data = '\n'.join(diff_index) + '\n'
+        
+        hashfuncs = self._new_release_hashfuncs()
+        for hashfunc in hashfuncs:
+            hashfunc.update(diff_index_data)
+        digests = tuple(hashfunc.hexdigest() for hashfunc in hashfuncs)
+        
+        diff_index_path = '{0}/{1}'.format(diff_dir, self._PDIFF_INDEX_FILENAME)
+        digest = digests[self._RELEASE_HASH_TYPES.index(self._BY_HASH_TYPE)]
+        self._store_metadata(diff_index_path, diff_index_data, digest)
+        self._store_by_hash(diff_index_path, [digest])
+        
+        rel_diff_index_path = self._get_packages_relative_path(section, architecture) + \
+            self._PDIFF_EXTENSION + '/' + self._PDIFF_INDEX_FILENAME
+        return { rel_diff_index_path : (len(diff_index_data),) + digests }
+
+
+    def _get_previous_by_hash(self, metadata_path):
+        """
+        Returns the uncompressed file of the most recent generation of an index file
+        stored by hash or None if it isn't available (see _store_by_hash)
+        """
+        generations = cache.get(self._get_by_hash_dir(metadata_path) +
+                                self._GENERATIONS_EXTENSION) or {}
+        if not generations.get(metadata_path):
+            return None
+
+        return cache.get(self._get_by_hash_path(metadata_path,
+                                                generations[metadata_path][-1][0]))
+
+
+    def _store_by_hash(self, metadata_path, digests):
+        """
+        Records a new generation of an index file whose formats were stored by hash
+        (see _store_metadata) and expires its oldest generations (see
+        APTREPO_BY_HASH_GENERATIONS).  The generations of every index file sharing a
+        by-hash directory are tracked together since identical files share a digest.
+
+        metadata_path - path of the index file (in its uncompressed format)
+        digests - list of the digests of each format of the index file starting with
+                  the uncompressed format
+        """
+        by_hash_dir = self._get_by_hash_dir(metadata_path)
+        generations_path = by_hash_dir + self._GENERATIONS_EXTENSION
+        num_generations = max(settings.APTREPO_BY_HASH_GENERATIONS, 1)
+        with _by_hash_lock:
+            # track the digests of each generation with the most recent one last
+            all_generations = cache.get(generations_path) or {}
+            generations = all_generations.get(metadata_path, [])
+            if digests in generations:
+                generations.remove(digests)
+            generations.append(digests)
+
+            expired_generations = generations[:-num_generations]
+            all_generations[metadata_path] = generations[-num_generations:]
+            cache.set(generations_path, all_generations, self._BY_HASH_CACHE_TIMEOUT)
+
+        retained_digests = set(digest for generations in all_generations.values()
+                               for generation in generations for digest in generation)
+        expired_paths = set(self._get_by_hash_path(metadata_path, digest)
+                            for generation in expired_generations for digest in generation
+                            if digest not in retained_digests)
+        if expired_paths:
+            self._unpublish_metadata(expired_paths)
+            cache.delete_many(expired_paths)
+
+
+    def _sign_release(self, distribution, sections, architectures, index_entries, generation):
+        """
+        Constructs, signs and caches the Release data for a distribution along with the
+        manifest of its index files (see _publish_manifest)
+        
+        distribution - distribution model object
+        sections - list of section names in the distribution
+        architectures - list of architecture names in the distribution
+        index_entries - dictionary mapping the relative path of each index file to
+                        its (size, md5, sha1, sha256) entry
+        generation - generation of the distribution when the rebuild started
+                        
+        Returns a tuple containing the Release data, its detached signature and the 
+        inline signed Release data
+        """
+        # create new release with header        
+        release = {}
+        release['Origin'] = distribution.origin
+        release['Label'] = distribution.label
+        release['Codename'] = distribution.name
+        release['Date'] = distribution.creation_date.strftime('%a, %d %b %Y %H:%M:%S %z UTC')
+        release['Description'] = distribution.description
+        release['Architectures'] = ' '.join(architectures)
+        release['Components'] = ' '.join(sections)
+        release['Acquire-By-Hash'] = 'yes'
+
+        release_data = []
+        for k,v in release.items():
+            release_data.append('{0}: {1}'.format(k, v))
+        
+        # list the hashes of every index file in a fixed order so that the
+        # Release data is identical regardless of how the index entries were built
+        for (i, hash_type) in enumerate(self._RELEASE_HASH_TYPES):
+            release_data.append(hash_type + ':')
+            for section in sections:
+                for architecture in architectures:
+                    index_paths = self._get_index_paths(distribution.name, section, architecture)
+                    for (rel_path, metadata_path) in index_paths:
+                        entry = index_entries[rel_path]
+                        release_data.append(
+                            ' {0} {1} {2}'.format(entry[i + 1], entry[0], rel_path))
+                
+        # the manifest lists the digest of every file so that readers retrieve the 
+        # index files which match the Release data
+        index_digests = {}
+        for section in sections:
+            for architecture in architectures:
+                for (rel_path, metadata_path) in self._get_index_paths(distribution.name, 
+                                                                        section, architecture):
+                    index_digests[metadata_path] = self._get_index_digest(index_entries[rel_path])
+                    
+        return self._publish_release(distribution.name, generation, '\n'.join(release_data), 
+                                     index_digests)
+
+
+    def _publish_release(self, distribution_name, generation, release_contents, index_digests,
+                         release_signatures=None):
+        """
+        Signs the Release data of a distribution and publishes it along with the manifest
+        of its files (see _publish_manifest)
+        
+        generation - generation of the distribution when the rebuild started
+        release_contents - the Release data
+        index_digests - dictionary mapping the metadata path of each index file to its 
+                        SHA256 digest
+        release_signatures - (optional) detached signature and inline signed data of the
+                             Release data if it was already signed (see sign_releases)
+        
+        Returns a tuple containing the Release data, its detached signature and the 
+        inline signed Release data
+        """
+        # create the detached and inline GPG signatures for release data using 
+        # the same signing context
+        if release_signatures is None:
+            release_signatures = sign_releases([release_contents])[0]
+        (release_signature, inline_release) = release_signatures
+        
+        releases_path = self._get_releases_path(distribution_name)
+        inline_release_path = self._get_inline_release_path(distribution_name)
+        cached_release = (release_contents, release_signature, inline_release)
+        
+        digests = dict(index_digests)
+        digests[releases_path] = hashlib.sha256(release_contents).hexdigest()
+        digests[releases_path + constants.GPG_EXTENSION] = \
+            hashlib.sha256(release_signature).hexdigest()
+        digests[inline_release_path] = hashlib.sha256(inline_release).hexdigest()
+        
+        published_generation = self._publish_manifest(distribution_name, generation, 
+                                                      cached_release, digests)
+        if published_generation is not None:
+            # the Release files are removed while the index files are replaced so that 
+            # the web server never serves them with index files they don't list
+            self._unpublish_metadata(self._get_release_paths(distribution_name))
+            for (metadata_path, digest) in index_digests.items():
+                self._publish_index_file(metadata_path, digest)
+            self._publish_metadata(releases_path + constants.GPG_EXTENSION, release_signature)
+            self._publish_metadata(releases_path, release_contents)
+            self._publish_metadata(inline_release_path, inline_release)
+            
+            # an invalidation while the files were written may have missed them (see 
+            # _clear_cache)
+            if self._get_generation(distribution_name) != published_generation:
+                self._unpublish_metadata(self._get_release_paths(distribution_name))
+        
+        return cached_release
+
+
+    def _publish_manifest(self, distribution_name, generation, release, digests):
+        """
+        Caches the manifest of a distribution's metadata, which contains its Release data
+        and the validators of each of its files, and makes it current.  
+        
+        A manifest is never modified once cached, so readers always retrieve a consistent 
+        set of files.  If the current generation already has a manifest, the generation is
+        advanced first unless another process advanced it meanwhile.
+        
+        generation - generation of the distribution when the rebuild started
+        release - tuple containing the Release data and its signatures
+        digests - dictionary mapping the metadata path of each file to its SHA256 digest
+        
+        Returns the generation of the published manifest or None if the distribution was 
+        invalidated since the rebuild started (in which case it will be rebuilt again)
+        """
+        if cache.has_key(self._get_manifest_path(distribution_name, generation)):
+            if not self._next_generation(distribution_name, generation):
+                return None
+            generation += 1
+        
+        # the last modified times of unchanged files are retained
+        previous_manifest = self._get_manifest(
+            distribution_name, cache.get(self._get_published_path(distribution_name)))
+        previous_files = previous_manifest['files'] if previous_manifest else {}
+        now = time.time()
+        files = {}
+        for (metadata_path, digest) in digests.items():
+            validators = previous_files.get(metadata_path)
+            if not validators or validators[0] != digest:
+                validators = (digest, now)
+            files[metadata_path] = validators
+        
+        timeout = cache.default_timeout + settings.APTREPO_METADATA_MAX_STALENESS
+        cache.set(self._get_manifest_path(distribution_name, generation), 
+                  {'release' : release, 'files' : files}, timeout)
+        cache.set(self._get_published_path(distribution_name), generation, timeout)
+        if settings.APTREPO_METADATA_MAX_STALENESS > 0:
+            cache.set(self._get_stale_path(distribution_name), generation, timeout)
+        
+        if self._get_generation(distribution_name) != generation:
+            return None
+        cache.delete(self._get_invalidated_path(distribution_name))
+        return generation
         
    
-    def _refresh_releases_data(self, distribution_name):
+    def _refresh_releases_data(self, distribution_name, missing_path=None, rebuild_all=False):
         """
-        Computes and caches the metadata files for a distribution 
+        Computes and caches the metadata files for a distribution.  Only the index files
+        which aren't cached (or whose entries aren't stored) are rebuilt unless 
+        rebuild_all is set.
+        
+        missing_path - (optional) the metadata is only rebuilt if this cached metadata is
+                       still missing once the lock is acquired (i.e. it wasn't rebuilt by 
+                       a concurrent caller)
+        rebuild_all - (optional) if true, all the index files are rebuilt
+                     
+        Returns a tuple containing the Release data, its detached signature and the 
+        inline signed Release data (or None if the rebuild was skipped)
         """
         
         self.logger.debug('Rebuilding Debian Releases for distribution=' + distribution_name)
@@ -621,135 +1701,641 @@ class Repository():
         # Use an interprocess file lock for reconstructing all Release data to ensure that
         # its hashes are valid since the Packages files much be computed separately.  The lock file
         # is specific to each distribution
-        lock_filename = os.path.join(settings.APTREPO_VAR_ROOT, '.releases-' + distribution_name)
-        with FileLock(lock_filename):
+        with self._lock_distribution(distribution_name):
+            
+            generation = self._get_generation(distribution_name)
+            if missing_path and \
+               self._get_generation_metadata(distribution_name, generation, missing_path) is not None:
+                return None
         
             distribution = models.Distribution.objects.get(name=distribution_name)
             sections = models.Section.objects.filter(distribution=distribution).values_list('name', flat=True)
-            architectures = distribution.get_architecture_list()
-    
-            # create new release with header        
-            release = {}
-            release['Origin'] = distribution.origin
-            release['Label'] = distribution.label
-            release['Codename'] = distribution.name
-            release['Date'] = distribution.creation_date.strftime('%a, %d %b %Y %H:%M:%S %z UTC')
-            release['Description'] = distribution.description
-            release['Architectures'] = ' '.join(architectures)
-            release['Components'] = ' '.join(sections)
-    
-            hash_types = ['MD5Sum', 'SHA1', 'SHA256']
-            release_hashes = {}
-            for h in hash_types:
-                release_hashes[h] = []
-    
-            release_data = []
-            for k,v in release.items():
-                release_data.append('{0}: {1}'.format(k, v))
-                
-            # compute hashes for all package lists
-            tmp_fh = None
-            compressed_fh = None
+            architectures = self._get_index_architectures(distribution)
+    
+            # the stored entries of index files which are still cached are reused
+            index_entries = self._get_index_entries(distribution, generation)
+    
+            # Build the package lists sequentially since they require database access, 
+            # compressing and hashing each entry as it is written, and cache them 
+            # concurrently.  The results are merged in the order the jobs were submitted
+            # and the number of jobs in flight is bounded so that only a few indexes are 
+            # held in memory at once
+            pending_results = collections.deque()
+            max_pending_results = 2 * self._get_metadata_workers()
+            
+            def merge_result():
+                (section, architecture, result) = pending_results.popleft()
+                section_entries = result.get()
+                self._store_index_entries(distribution, section, architecture, 
+                                          section_entries, generation)
+                index_entries.update(section_entries)
+            
+            pool = self._create_metadata_pool()
             try:
-                tmp_fd, tmp_filename = tempfile.mkstemp(prefix=self._PACKAGES_FILENAME)
-                compressed_filename = tmp_filename + constants.GZIP_EXTENSION
-                tmp_fh = os.fdopen(tmp_fd, 'wb+')
-                compressed_fh = open(compressed_filename, 'wb+')
-                
                 for section in sections:
                     for architecture in architectures:
-    
-                        # create the Packages file            
-                        tmp_fh.seek(0)
-                        tmp_fh.truncate(0)
-                        self._write_package_list(tmp_fh, distribution_name, section, 
-                                                 architecture)
-                        tmp_fh.flush()
-                        tmp_file_size = tmp_fh.tell()
+                        if not rebuild_all and self._is_index_cached(
+                            distribution_name, section, architecture, index_entries):
+                            continue
                         
-                        # create the compressed version using a timestamp (mtime) of 0
-                        # 
-                        # TODO Remove conditions around mtime once python v2.7 becomes the minimum 
-                        # supported version
-                        compressed_fh.seek(0)
-                        compressed_fh.truncate(0)
-                        gzip_params = {
-                                       'filename':self._PACKAGES_FILENAME, 'mode':'wb', 'compresslevel':9, 
-                                       'fileobj':compressed_fh}
-                        if get_python_version() >= 2.7:
-                            gzip_params['mtime'] = 0 
+                        while len(pending_results) >= max_pending_results:
+                            merge_result()
+                        
+                        index_writer = self._create_packages_writer()
+                        self._write_package_list(index_writer, distribution_name, section, 
+                                                 architecture)
+                        pending_results.append(
+                            (section, architecture,
+                             pool.apply_async(self._cache_package_list, 
+                                              (distribution_name, section, architecture, 
+                                               index_writer))))
                         
-                        gzip_fh = gzip.GzipFile(**gzip_params)
-                        tmp_fh.seek(0)
-                        shutil.copyfileobj(fsrc=tmp_fh, fdst=gzip_fh)
-                        gzip_fh.close()
-                        compressed_file_size = compressed_fh.tell()
-    
-                        # for python v2.6 and earlier, we need to manually set the mtime field to
-                        # zero.  This starts at position 4 of the file (see RFC 1952)                    
-                        if get_python_version() < 2.7:
-                            compressed_fh.seek(4)
-                            compressed_fh.write(struct.pack('<i',0))
-    
-                        packages_path = self._get_packages_path(distribution_name, section, architecture)
-                        rel_packages_path = self._get_packages_relative_path(section, architecture)
-                        tmp_fh.seek(0)
-                        cache.set( packages_path, tmp_fh.read() )
-                        compressed_fh.seek(0)
-                        cache.set( packages_path + constants.GZIP_EXTENSION, 
-                                   compressed_fh.read(compressed_file_size) )
+                        if settings.APTREPO_CONTENTS_INDEXES:
+                            contents_fh = cStringIO.StringIO()
+                            self._write_contents_list(contents_fh, distribution_name, section,
+                                                      architecture)
+                            pending_results.append(
+                                (section, architecture,
+                                 pool.apply_async(self._cache_contents_list, 
+                                                  (distribution_name, section, architecture, 
+                                                   contents_fh.getvalue()))))
                         
-                        # hash the package list for each hash function
-                        for type in hash_types:
-                            release_hashes[type].append(
-                                ' {0} {1} {2}'.format(hash_file_by_fh(self._get_hashfunc(type), tmp_fh), 
-                                                      tmp_file_size, 
-                                                      rel_packages_path))
-                            release_hashes[type].append(
-                                ' {0} {1} {2}'.format(hash_file_by_fh(self._get_hashfunc(type), compressed_fh), 
-                                                      compressed_file_size, 
-                                                      rel_packages_path + constants.GZIP_EXTENSION))
-    
-            finally:                        
-                if tmp_fh:
-                    tmp_fh.close()
-                if compressed_fh:
-                    compressed_fh.close()
-                os.remove(tmp_filename)
-                if os.path.exists(compressed_filename):
-                    os.remove(compressed_filename)
+                while pending_results:
+                    merge_result()
+            finally:
+                pool.close()
+                pool.join()
                         
-            for hash_type, hash_list in release_hashes.items():
-                release_data.append(hash_type + ':')
-                release_data.extend( hash_list )
+            return self._sign_release(distribution, sections, architectures, index_entries, 
+                                      generation)
+
+
+    def _refresh_releases_data_in_background(self, distribution_name, missing_path):
+        """
+        Rebuilds the metadata for a distribution in a background thread unless this 
+        process is already rebuilding it (see _refresh_releases_data)
+        """
+        with _background_refreshes_lock:
+            if distribution_name in _background_refreshes:
+                return
+            _background_refreshes.add(distribution_name)
+            
+        def refresh():
+            try:
+                self._refresh_releases_data(distribution_name, missing_path)
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                with _background_refreshes_lock:
+                    _background_refreshes.discard(distribution_name)
+                # the thread has its own database connection
+                connection.close()
+        
+        refresh_thread = threading.Thread(target=refresh)
+        refresh_thread.daemon = True
+        refresh_thread.start()
+
+
+    def _update_package_lists(self, section, package, removed=False):
+        """
+        Applies a single package change as a delta to the cached Packages lists
+        of a section and re-signs the Release data for its distribution.
+        
+        Only the Packages lists and Contents indexes for the package's architecture are 
+        modified.  If any of the required metadata is not cached, the affected indexes are
+        invalidated instead.
+        
+        section - section model object containing the changed package
+        package - package model object that was added or removed
+        removed - (optional) if true, the package was removed from the section
+        """
+        distribution = section.distribution
+        architectures = self._get_index_architectures(distribution)
+        if package.architecture == models.Architecture.ARCHITECTURE_ALL and \
+           not settings.APTREPO_SEPARATE_ARCHITECTURE_ALL:
+            affected_architectures = architectures
+        else:
+            affected_architectures = [package.architecture]
+            
+        if not settings.APTREPO_INCREMENTAL_INDEXES:
+            self._invalidate_metadata(distribution.name, section.name, affected_architectures)
+            return
+        
+        self.logger.debug('Updating Debian Packages lists for {0}:{1} ({2} {3})'.format(
+            distribution.name, section.name, 'removed' if removed else 'added', package))
+        
+        with self._lock_distribution(distribution.name):
+            
+            generation = self._get_generation(distribution.name)
+            sections = models.Section.objects.filter(distribution=distribution).values_list('name', flat=True)
+            index_entries = self._get_index_entries(distribution, generation)
+            
+            # apply the delta to each affected Packages list and Contents index
+            stanza = self._get_package_stanza(package)
+            packages_lists = {}
+            contents_lists = {}
+            for architecture in affected_architectures:
+                packages_path = self._get_packages_path(distribution.name, section.name, architecture)
+                packages_data = self._get_index_content(
+                    packages_path, index_entries.get(
+                        self._get_packages_relative_path(section.name, architecture)))
+                if packages_data is None:
+                    self._invalidate_metadata(distribution.name, section.name, 
+                                              affected_architectures)
+                    return
+                
+                if removed:
+                    offset = packages_data.find(stanza)
+                    if offset < 0:
+                        self._invalidate_metadata(distribution.name, section.name,
+                                                  affected_architectures)
+                        return
+                    packages_data = packages_data[:offset] + packages_data[offset + len(stanza):]
+                else:
+                    packages_data = packages_data + stanza
+                    
+                packages_lists[architecture] = packages_data
+                
+                if settings.APTREPO_CONTENTS_INDEXES:
+                    contents_data = self._get_index_content(
+                        self._get_contents_path(distribution.name, section.name, architecture),
+                        index_entries.get(
+                            self._get_contents_relative_path(section.name, architecture)))
+                    if contents_data is None:
+                        self._invalidate_metadata(distribution.name, section.name, 
+                                                  affected_architectures)
+                        return
+                    contents_lists[architecture] = self._update_contents_list(
+                        contents_data, distribution.name, section.name, architecture, package,
+                        removed)
+                
+            # recompute the affected indexes and re-sign the release
+            for architecture, packages_data in packages_lists.items():
+                index_writer = self._create_packages_writer()
+                index_writer.write(packages_data)
+                section_entries = self._cache_package_list(distribution.name, section.name, 
+                                                           architecture, index_writer)
+                
+                if settings.APTREPO_CONTENTS_INDEXES:
+                    section_entries.update(
+                        self._cache_contents_list(distribution.name, section.name, architecture,
+                                                  contents_lists[architecture]))
                     
-            # create GPG signature for release data
-            release_contents = '\n'.join(release_data)
-            gpg_signer = GPGSigner()
-            release_signature = gpg_signer.sign_data(release_contents)
+                self._store_index_entries(distribution, section.name, architecture, 
+                                          section_entries, generation)
+                index_entries.update(section_entries)
             
-            releases_path = self._get_releases_path(distribution)
-            cache.set(releases_path, (release_contents, release_signature) )
+            try:
+                self._sign_release(distribution, sections, architectures, index_entries, 
+                                   generation)
+            except KeyError:
+                # the entries of other indexes are missing so only the Release data needs
+                # to be rebuilt
+                self._invalidate_metadata(distribution.name, section.name, [])
+
+
+    def _get_index_entries(self, distribution, generation):
+        """
+        Returns a dictionary mapping the relative path of each index file with a stored
+        entry to its (size, md5, sha1, sha256) entry.  Entries of older generations 
+        (i.e. of index files which were invalidated or built from data which changed
+        since, see _clear_cache) and of index files built with a different 
+        APTREPO_SEPARATE_ARCHITECTURE_ALL setting are left out.
+        
+        generation - generation of the distribution when the rebuild started
+        """
+        index_files = models.IndexFile.objects.filter(
+            distribution=distribution, generation__gte=generation,
+            separate_architecture_all=settings.APTREPO_SEPARATE_ARCHITECTURE_ALL).values_list(
+            'path', 'size', 'hash_md5', 'hash_sha1', 'hash_sha256')
+        
+        index_entries = {}
+        for row in index_files:
+            index_entries[row[0]] = row[1:]
+        return index_entries
+    
+    def _store_index_entries(self, distribution, section, architecture, index_entries, 
+                             generation):
+        """
+        Stores the entries of the index files for an architecture within a section 
+        (see _get_index_entries)
+        
+        generation - generation of the distribution when the rebuild started
+        """
+        models.IndexFile.objects.filter(distribution=distribution, 
+                                        path__in=index_entries.keys()).delete()
+        for (path, (size, hash_md5, hash_sha1, hash_sha256)) in index_entries.items():
+            models.IndexFile.objects.create(
+                distribution=distribution, section=section, architecture=architecture, 
+                path=path, size=size, hash_md5=hash_md5, hash_sha1=hash_sha1, 
+                hash_sha256=hash_sha256, generation=generation,
+                separate_architecture_all=settings.APTREPO_SEPARATE_ARCHITECTURE_ALL)
+            
+    def _is_index_cached(self, distribution_name, section, architecture, index_entries):
+        """
+        Determines whether all the index files for an architecture within a section are
+        cached and have stored entries
+        """
+        for (rel_path, metadata_path) in self._get_index_paths(distribution_name, section, 
+                                                                architecture):
+            if rel_path not in index_entries or not cache.has_key(
+                self._get_by_hash_path(metadata_path, self._get_index_digest(index_entries[rel_path]))):
+                return False
+            
+        return True
+    
+    def _get_index_digest(self, index_entry):
+        """
+        Returns the digest which identifies the cached contents of an index file given its
+        (size, md5, sha1, sha256) entry
+        """
+        return index_entry[self._RELEASE_HASH_TYPES.index(self._BY_HASH_TYPE) + 1]
+    
+    def _get_index_content(self, metadata_path, index_entry):
+        """
+        Returns the cached contents of an index file given its stored entry (which may be 
+        None) or None if it isn't cached
+        """
+        if index_entry is None:
+            return None
+        return cache.get(self._get_by_hash_path(metadata_path, self._get_index_digest(index_entry)))
+
+
+    def _get_index_architectures(self, distribution):
+        """
+        Returns the list of architectures with index files for a distribution, which
+        includes 'all' if architecture independent packages are published separately
+        """
+        architectures = distribution.get_architecture_list()
+        if settings.APTREPO_SEPARATE_ARCHITECTURE_ALL and \
+           models.Architecture.ARCHITECTURE_ALL not in architectures:
+            architectures.append(models.Architecture.ARCHITECTURE_ALL)
             
-            return (release_contents, release_signature)
+        return architectures
 
 
-    def _clear_cache(self, distribution_name):
+    def _get_packages_compression(self):
+        """
+        Returns the list of (extension, compression level) tuples for the supported
+        compressed formats of the Packages lists (see APTREPO_PACKAGES_COMPRESSION)
+        """
+        compression = []
+        for (extension, compresslevel) in settings.APTREPO_PACKAGES_COMPRESSION:
+            if is_compression_supported(extension):
+                compression.append( (extension, compresslevel) )
+            elif extension not in _unsupported_compression:
+                _unsupported_compression.add(extension)
+                self.logger.warning('Compression format is not supported: ' + extension)
+                
+        return compression
+
+
+    def _create_metadata_pool(self):
+        """
+        Creates a worker pool for generating metadata files concurrently
+        """
+        return ThreadPool(self._get_metadata_workers())
+
+
+    def _get_metadata_workers(self):
+        """
+        Returns the number of workers for generating metadata (see APTREPO_METADATA_WORKERS)
+        """
+        num_workers = settings.APTREPO_METADATA_WORKERS
+        if num_workers <= 0:
+            num_workers = multiprocessing.cpu_count()
+        return num_workers
+
+
+    def _invalidate_metadata(self, distribution_name, section_name=None, architectures=None):
+        """
+        Invalidates the metadata of a distribution.  If background regeneration is 
+        enabled, the distribution is marked as dirty and its current metadata is served
+        until it is rebuilt (see regenerate_dirty_distributions).  Otherwise the cached 
+        metadata is cleared (see _clear_cache).
+        """
+        if not settings.APTREPO_BACKGROUND_REGENERATION:
+            self._clear_cache(distribution_name, section_name, architectures)
+            return
         
-        self.logger.debug('Clearing cached metadata for distribution: ' + 
+        self.logger.debug('Marking metadata as dirty for distribution: ' + 
                           distribution_name)
         
-        distribution = models.Distribution.objects.get(name=distribution_name)
-        sections = models.Section.objects.filter(distribution=distribution).values_list('name', flat=True)
-        architectures = distribution.get_architecture_list()
+        # the marker's contents record when the distribution first became dirty and 
+        # its modification time records the latest invalidation
+        dirty_filename = self._get_dirty_filename(distribution_name)
+        try:
+            os.utime(dirty_filename, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            write_file_atomically(dirty_filename, str(time.time()))
+
+    def _get_invalidation_times(self, distribution_name):
+        """
+        Returns a tuple with the times of the first and latest invalidations of a dirty 
+        distribution or None if it isn't dirty (see _invalidate_metadata)
+        """
+        dirty_filename = self._get_dirty_filename(distribution_name)
+        try:
+            last_invalidated = os.stat(dirty_filename).st_mtime
+            with open(dirty_filename) as fh:
+                first_invalidated = float(fh.read())
+        except (IOError, OSError, ValueError):
+            return None
         
-        for section in sections:
-            for architecture in architectures:
-                packages_path = self._get_packages_path(distribution_name, section, architecture)
-                cache.delete_many([ packages_path, packages_path + constants.GZIP_EXTENSION ])
+        return (first_invalidated, last_invalidated)
+
+
+    def _clear_cache(self, distribution_name, section_name=None, architectures=None):
+        """
+        Invalidates the cached metadata of a distribution by advancing its generation.  
+        The stored entries of the cleared index files are left behind in the previous 
+        generation so that they are rebuilt (see _get_index_entries).  The cached files 
+        are left to expire since readers only retrieve the files listed in the manifest 
+        of the current generation.
         
-        releases_path = self._get_releases_path(distribution_name)
-        cache.delete_many([releases_path, releases_path + constants.GPG_EXTENSION])
+        The distribution lock isn't acquired, so an invalidation never waits for a 
+        rebuild.  A concurrent rebuild stores its entries in the generation it started 
+        with, which is ignored by the rebuilds of the new generation.
+        
+        section_name - (optional) only clear the index files of this section
+        architectures - (optional) only clear the index files of these architectures
+        """
+        
+        self.logger.debug('Clearing cached metadata for distribution: {0} (section={1}, architectures={2})'.format(
+            distribution_name, section_name or 'all', 
+            'all' if architectures is None else ' '.join(architectures)))
+        
+        if section_name is None and architectures is None:
+            self._next_generation(distribution_name)
+        else:
+            cleared_index_files = Q()
+            if section_name is not None:
+                cleared_index_files &= Q(section=section_name)
+            if architectures is not None:
+                cleared_index_files &= Q(architecture__in=architectures)
+            
+            # the other entries are carried over by a compare-and-set of the generation,
+            # which is retried if the generation was advanced concurrently
+            while True:
+                generation = self._get_generation(distribution_name)
+                if generation is None or \
+                   self._next_generation(distribution_name, generation, cleared_index_files):
+                    break
+            
+        # remove the published Release files once the generation was advanced so that the
+        # web server never serves them with stale package lists (the index files are 
+        # replaced once rebuilt)
+        self._unpublish_metadata(self._get_release_paths(distribution_name))
+        cache.set(self._get_invalidated_path(distribution_name), time.time(), 
+                  cache.default_timeout + settings.APTREPO_METADATA_MAX_STALENESS)
+    
+    @contextmanager
+    def _lock_distribution(self, distribution_name):
+        """
+        Acquires the interprocess lock of a distribution, which serializes the changes to 
+        its metadata, unless the current thread already holds it
+        """
+        held_locks = getattr(_held_distribution_locks, 'names', None)
+        if held_locks is None:
+            held_locks = _held_distribution_locks.names = set()
+        if distribution_name in held_locks:
+            yield
+            return
+        
+        with FileLock(self._get_lock_filename(distribution_name)):
+            held_locks.add(distribution_name)
+            try:
+                yield
+            finally:
+                held_locks.discard(distribution_name)
+    
+    def _open_index_file(self, distribution_name, metadata_path, digest=None):
+        """
+        Opens the by-hash copy of an index file so that its contents match the digest 
+        even if the index file is rebuilt concurrently (see _store_metadata)
+        
+        digest - (optional) SHA256 digest of the index file, defaults to the digest 
+                 listed in the manifest of the current generation
+        
+        Returns an open file object or None if the file isn't stored
+        """
+        if digest is None:
+            manifest = self._get_manifest(distribution_name, 
+                                          self._get_generation(distribution_name))
+            validators = manifest and manifest['files'].get(metadata_path)
+            if not validators:
+                return None
+            digest = validators[0]
+            
+        try:
+            return open(self._get_metadata_filename(
+                self._get_by_hash_path(metadata_path, digest)), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+    
+    def _get_packages_diff_entry(self, patch_path):
+        """
+        Returns the PDiff history entry of a compressed patch (see _cache_package_diffs)
+        or None if the patch isn't in the history
+        """
+        (diff_dir, filename) = os.path.split(patch_path)
+        history_path = '{0}/{1}{2}'.format(diff_dir, self._PDIFF_INDEX_FILENAME, 
+                                          self._HISTORY_EXTENSION)
+        for entry in cache.get(history_path) or []:
+            if entry[0] + constants.GZIP_EXTENSION == filename:
+                return entry
+        return None
+    
+    def _get_cached_metadata(self, distribution_name, metadata_path):
+        """
+        Retrieves cached metadata of the current generation and rebuilds the metadata for 
+        the distribution if it is missing.  The previous metadata is returned instead of 
+        waiting for the rebuild if it isn't older than APTREPO_METADATA_MAX_STALENESS, in 
+        which case the rebuild occurs in the background.
+        
+        Returns the cached metadata or None if it doesn't exist after the rebuild
+        """
+        data = self._get_generation_metadata(distribution_name, 
+                                             self._get_generation(distribution_name), 
+                                             metadata_path)
+        if data is not None:
+            return data
+        
+        if settings.APTREPO_METADATA_MAX_STALENESS > 0:
+            stale_data = self._get_generation_metadata(
+                distribution_name, cache.get(self._get_stale_path(distribution_name)), 
+                metadata_path)
+            invalidated = cache.get(self._get_invalidated_path(distribution_name))
+            if stale_data is not None and \
+               (invalidated is None or 
+                time.time() - invalidated <= settings.APTREPO_METADATA_MAX_STALENESS):
+                self.logger.debug('Serving stale metadata at: ' + metadata_path)
+                self._refresh_releases_data_in_background(distribution_name, metadata_path)
+                return stale_data
+        
+        self._refresh_releases_data(distribution_name, metadata_path)
+        return self._get_generation_metadata(distribution_name, 
+                                             self._get_generation(distribution_name), 
+                                             metadata_path)
+    
+    def _get_generation_metadata(self, distribution_name, generation, metadata_path):
+        """
+        Retrieves a metadata file of a distribution as listed in the manifest of a 
+        generation (see _publish_manifest)
+        
+        Returns the metadata (a tuple for the Release data) or None if the generation 
+        has no manifest or the file isn't cached
+        """
+        manifest = self._get_manifest(distribution_name, generation)
+        if manifest is None:
+            return None
+        
+        if metadata_path == self._get_releases_path(distribution_name):
+            return manifest['release']
+        
+        validators = manifest['files'].get(metadata_path)
+        if validators is None:
+            return None
+        return self._get_immutable_metadata(self._get_by_hash_path(metadata_path, validators[0]))
+    
+    def _get_manifest(self, distribution_name, generation):
+        """
+        Returns the manifest of a generation of a distribution or None if it isn't cached
+        """
+        if generation is None:
+            return None
+        return self._get_immutable_metadata(self._get_manifest_path(distribution_name, generation))
+    
+    def _get_immutable_metadata(self, cache_key):
+        """
+        Retrieves metadata which never changes once it is cached (i.e. a manifest or the
+        contents of a file) from the in-memory cache or else from the shared cache
+        """
+        if settings.APTREPO_MEMORY_CACHE_SIZE > 0:
+            data = _memory_cache.get(cache_key)
+            if data is not None:
+                return data
+        
+        data = cache.get(cache_key)
+        _shared_cache_statistics.record(data is not None)
+        if data is not None and settings.APTREPO_MEMORY_CACHE_SIZE > 0:
+            _memory_cache.set(cache_key, data, self._get_metadata_size(data))
+        return data
+    
+    def _get_metadata_size(self, data):
+        if isinstance(data, dict):
+            # approximate size of a manifest
+            return self._get_metadata_size(data['release']) + 256 * len(data['files'])
+        elif isinstance(data, tuple):
+            return sum(len(item) for item in data)
+        return len(data)
+    
+    def _get_generation(self, distribution_name):
+        """
+        Retrieves the generation of a distribution's metadata, which changes whenever any 
+        of its metadata is rebuilt or invalidated
+        
+        Returns the generation or None if the distribution doesn't exist
+        """
+        generations = models.Distribution.objects.filter(name=distribution_name).values_list(
+            'metadata_generation', flat=True)
+        return generations[0] if generations else None
+    
+    def _next_generation(self, distribution_name, generation=None, cleared_index_files=None):
+        """
+        Atomically advances the generation of a distribution's metadata (see 
+        _get_generation).  If the previous generation is given, the stored entries of 
+        its index files are carried over to the new generation (see _get_index_entries).
+        
+        generation - (optional) only advance the generation if it is still this one
+        cleared_index_files - (optional) Q object matching the entries which aren't 
+                              carried over
+        
+        Returns true if the generation was advanced
+        """
+        distributions = models.Distribution.objects.filter(name=distribution_name)
+        if generation is None:
+            return distributions.update(metadata_generation=F('metadata_generation') + 1) > 0
+        
+        if not distributions.filter(metadata_generation=generation).update(
+            metadata_generation=F('metadata_generation') + 1):
+            return False
+        
+        index_files = models.IndexFile.objects.filter(distribution__name=distribution_name,
+                                                      generation=generation)
+        if cleared_index_files is not None:
+            index_files = index_files.exclude(cleared_index_files)
+        index_files.update(generation=generation + 1)
+        return True
+    
+    def _cache_validators(self, metadata_path, data):
+        """
+        Caches the validators of a metadata file (see get_metadata_validators).  The
+        last modified time is kept if the file's contents haven't changed.
+        """
+        validators_path = self._get_validators_path(metadata_path)
+        etag = hashlib.sha256(data).hexdigest()
+        validators = cache.get(validators_path)
+        if not validators or validators[0] != etag:
+            validators = (etag, time.time())
+        cache.set(validators_path, validators)
+            
+    def _store_metadata(self, metadata_path, data, digest):
+        """
+        Caches the contents of a metadata file under its by-hash path and writes it to
+        disk there (see _publish_metadata).  The file is served once a manifest which 
+        lists the digest is published, which is also when it is published under its own
+        path (see _publish_index_file).  The by-hash copy is kept until its generation 
+        expires (see _store_by_hash).
+
+        digest - hexadecimal SHA256 digest of the data
+        """
+        by_hash_path = self._get_by_hash_path(metadata_path, digest)
+        cache.set(by_hash_path, data, self._BY_HASH_CACHE_TIMEOUT)
+        self._publish_metadata(by_hash_path, data)
+        
+    def _publish_metadata(self, metadata_path, data):
+        """
+        Writes a metadata file to disk so that it can be streamed (see get_packages_file).
+        If APTREPO_PUBLISH_METADATA is enabled, the file is written under the public 
+        directory (MEDIA_ROOT) so that it can be served directly by the web server.
+        """
+        write_file_atomically(self._get_metadata_filename(metadata_path), data)
+
+    def _publish_index_file(self, metadata_path, digest):
+        """
+        Publishes an index file under its own path by linking it to its by-hash copy
+        (see _store_metadata)
+        """
+        by_hash_path = self._get_by_hash_path(metadata_path, digest)
+        try:
+            link_file_atomically(self._get_metadata_filename(by_hash_path), 
+                                 self._get_metadata_filename(metadata_path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # the by-hash copy was removed from disk, so it is restored from the cache
+            data = cache.get(by_hash_path)
+            if data is not None:
+                self._publish_metadata(by_hash_path, data)
+                self._publish_metadata(metadata_path, data)
+
+    def _unpublish_metadata(self, metadata_paths):
+        """
+        Removes metadata files from disk (see _publish_metadata)
+        """
+        for metadata_path in metadata_paths:
+            remove_file(self._get_metadata_filename(metadata_path))
+            
+    def _get_metadata_filename(self, metadata_path):
+        metadata_root = settings.APTREPO_METADATA_ROOT
+        if settings.APTREPO_PUBLISH_METADATA:
+            metadata_root = settings.MEDIA_ROOT
+        return os.path.join(metadata_root, metadata_path)
 
 
     def _get_packages_path(self, distribution, section, architecture):
@@ -766,13 +2352,105 @@ class Repository():
             self._PACKAGES_FILENAME)
         return packages_path
 
+    def _get_index_paths(self, distribution, section, architecture):
+        """
+        Returns a list of (relative path, metadata path) tuples for each index file of 
+        an architecture within a section which is listed in the Release file
+        """
+        packages_path = self._get_packages_path(distribution, section, architecture)
+        rel_packages_path = self._get_packages_relative_path(section, architecture)
+        index_paths = [ (rel_packages_path + extension, packages_path + extension) 
+                        for extension in self.get_packages_extensions() ]
+        
+        if settings.APTREPO_PDIFF_HISTORY > 0:
+            index_paths.append( 
+                ('{0}{1}/{2}'.format(rel_packages_path, self._PDIFF_EXTENSION, 
+                                     self._PDIFF_INDEX_FILENAME),
+                 '{0}/{1}'.format(self._get_packages_diff_dir(distribution, section, architecture),
+                                  self._PDIFF_INDEX_FILENAME)) )
+        if settings.APTREPO_CONTENTS_INDEXES:
+            index_paths.append( (self._get_contents_relative_path(section, architecture),
+                                 self._get_contents_path(distribution, section, architecture)) )
+            
+        return index_paths
+
+    def _get_contents_path(self, distribution, section, architecture):
+        contents_path = '{0}/{1}/{2}'.format(
+            settings.APTREPO_FILESTORE['metadata_subdir'],
+            distribution,
+            self._get_contents_relative_path(section, architecture))
+        return contents_path
+
+    def _get_contents_relative_path(self, section, architecture):
+        contents_path = '{0}/{1}-{2}{3}'.format(
+            section, self._CONTENTS_PREFIX, architecture, constants.GZIP_EXTENSION)
+        return contents_path
+
+    def _get_packages_diff_dir(self, distribution, section, architecture):
+        return self._get_packages_path(distribution, section, architecture) + \
+            self._PDIFF_EXTENSION
+
+    def _get_by_hash_dir(self, metadata_path):
+        by_hash_dir = '{0}/{1}/{2}'.format(os.path.dirname(metadata_path),
+                                           self._BY_HASH_DIRNAME, self._BY_HASH_TYPE)
+        return by_hash_dir
+
+    def _get_by_hash_path(self, metadata_path, digest):
+        return '{0}/{1}'.format(self._get_by_hash_dir(metadata_path), digest)
+
     def _get_releases_path(self, distribution):
         releases_path = '{0}/{1}/{2}'.format(
             settings.APTREPO_FILESTORE['metadata_subdir'],
             distribution, self._RELEASE_FILENAME)
         return releases_path
     
+    def _get_inline_release_path(self, distribution):
+        inline_release_path = '{0}/{1}/{2}'.format(
+            settings.APTREPO_FILESTORE['metadata_subdir'],
+            distribution, self._INLINE_RELEASE_FILENAME)
+        return inline_release_path
+
+    def _get_release_paths(self, distribution):
+        """
+        Returns the metadata paths of the Release files of a distribution (the inline 
+        signed Release, Release and Release.gpg)
+        """
+        releases_path = self._get_releases_path(distribution)
+        return [self._get_inline_release_path(distribution), releases_path, 
+                releases_path + constants.GPG_EXTENSION]
+
+    def _get_validators_path(self, metadata_path):
+        return metadata_path + self._VALIDATORS_EXTENSION
+
+    def _get_invalidated_path(self, distribution):
+        return '{0}/{1}/{2}'.format(settings.APTREPO_FILESTORE['metadata_subdir'],
+                                    distribution, self._INVALIDATED_FILENAME)
+
+    def _get_manifest_path(self, distribution, generation):
+        return '{0}/{1}/{2}@{3}'.format(settings.APTREPO_FILESTORE['metadata_subdir'],
+                                        distribution, self._MANIFEST_FILENAME, generation)
+
+    def _get_published_path(self, distribution):
+        return '{0}/{1}/{2}'.format(settings.APTREPO_FILESTORE['metadata_subdir'],
+                                    distribution, self._PUBLISHED_FILENAME)
+
+    def _get_stale_path(self, distribution):
+        return '{0}/{1}/{2}'.format(settings.APTREPO_FILESTORE['metadata_subdir'],
+                                    distribution, self._STALE_FILENAME)
+
+    def _get_lock_filename(self, distribution):
+        return os.path.join(settings.APTREPO_VAR_ROOT, '.releases-' + distribution)
+    
+    def _get_dirty_filename(self, distribution):
+        return os.path.join(settings.APTREPO_VAR_ROOT, '.dirty-' + distribution)
+    
     
+    def _new_release_hashfuncs(self):
+        """
+        Returns a new list of hashlib objects for the Release hash types
+        """
+        return [self._get_hashfunc(hash_type) for hash_type in self._RELEASE_HASH_TYPES]
+
     def _get_hashfunc(self, hash_name):
         name = hash_name.lower()
         if name == 'md5' or name == 'md5sum':
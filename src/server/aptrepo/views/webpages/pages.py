@@ -1,6 +1,9 @@
 from functools import wraps
 import httplib
+import json
 import logging
+import os
+import re
 from django import forms
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
@@ -9,9 +12,10 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.template import RequestContext
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext as _
 from django.views.decorators.csrf import csrf_protect
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import condition, require_http_methods
 from server.aptrepo import models
 from server.aptrepo.util import AuthorizationException, constants
 from server.aptrepo.views import get_repository_controller
@@ -25,6 +29,126 @@ class UploadPackageForm(forms.Form):
     section = forms.ModelChoiceField(queryset=models.Section.objects.all())
     comment = forms.CharField(required=False, max_length=models.Action.MAX_COMMENT_LENGTH)
 
+# content types for each format of the Packages lists
+_PACKAGES_MIMETYPES = {
+    '' : 'text/plain',
+    constants.GZIP_EXTENSION : 'application/gzip',
+    constants.BZIP2_EXTENSION : 'application/x-bzip2',
+    constants.XZ_EXTENSION : 'application/x-xz',
+}
+
+# size of the blocks read when streaming files
+_STREAM_BLOCK_SIZE = 64 * 1024
+
+# single byte range requests (e.g. 'bytes=0-499', 'bytes=500-' or 'bytes=-500')
+_BYTE_RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# by-hash files and PDiff patches never change content so they may be cached 
+# indefinitely (one year)
+_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+def _get_metadata_validators(request, metadata_path):
+    """
+    Returns the (ETag, last modified) validators of a metadata file, which are only
+    retrieved once per request
+    """
+    if not hasattr(request, 'metadata_validators'):
+        repository = get_repository_controller(request=request)
+        request.metadata_validators = \
+            repository.get_metadata_validators(metadata_path) or (None, None)
+    return request.metadata_validators
+
+def metadata_condition(metadata_path_func):
+    """
+    Decorator function for answering conditional requests (If-None-Match and 
+    If-Modified-Since) for a metadata file with a 304 response
+    
+    metadata_path_func - function returning the path of the metadata file relative to 
+                         the metadata directory given the arguments of the view
+    """
+    def etag_func(request, *args, **kwargs):
+        return _get_metadata_validators(request, metadata_path_func(*args, **kwargs))[0]
+    
+    def last_modified_func(request, *args, **kwargs):
+        return _get_metadata_validators(request, metadata_path_func(*args, **kwargs))[1]
+    
+    return condition(etag_func=etag_func, last_modified_func=last_modified_func)
+
+def _iter_file(fh, offset, length):
+    """
+    Generator which reads a range of an open file in blocks and then closes it
+    """
+    try:
+        fh.seek(offset)
+        while length > 0:
+            data = fh.read(min(length, _STREAM_BLOCK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fh.close()
+
+def _get_byte_range(request, size):
+    """
+    Parses the Range header of a request for a single byte range (requests for 
+    multiple ranges are answered with the whole file)
+    
+    Returns a tuple with the first and last byte positions of the range, None if the
+    whole file must be sent or raises ValueError if the range can't be satisfied
+    """
+    match = _BYTE_RANGE_REGEX.match(request.META.get('HTTP_RANGE', '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    
+    # the range only applies if the client's partial copy is current (see If-Range)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range:
+        etag = getattr(request, 'metadata_validators', (None, None))[0]
+        if not etag or if_range != '"{0}"'.format(etag):
+            return None
+    
+    (first, last) = match.groups()
+    if not first:
+        # suffix range containing the last bytes of the file
+        if int(last) == 0 or size == 0:
+            raise ValueError('Empty suffix range')
+        return (max(size - int(last), 0), size - 1)
+    
+    first = int(first)
+    last = int(last) if last else size - 1
+    if last < first:
+        return None
+    if first >= size:
+        raise ValueError('Range starts beyond the end of the file')
+    return (first, min(last, size - 1))
+
+def _stream_file_response(request, fh, mimetype):
+    """
+    Returns a response which streams an open file (or the byte range of it that was 
+    requested) and closes it
+    """
+    size = os.fstat(fh.fileno()).st_size
+    try:
+        byte_range = _get_byte_range(request, size)
+    except ValueError:
+        fh.close()
+        response = HttpResponse(status=httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+        response['Content-Range'] = 'bytes */{0}'.format(size)
+        return response
+    
+    if byte_range is None:
+        response = HttpResponse(_iter_file(fh, 0, size), mimetype=mimetype)
+        response['Content-Length'] = size
+    else:
+        (first, last) = byte_range
+        response = HttpResponse(_iter_file(fh, first, last - first + 1), mimetype=mimetype,
+                                status=httplib.PARTIAL_CONTENT)
+        response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(first, last, size)
+        response['Content-Length'] = last - first + 1
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
 def handle_exception(request_handler_func):
     """
     Decorator function for handling exceptions and converting them
@@ -59,6 +183,7 @@ def handle_exception(request_handler_func):
 
 @handle_exception
 @require_http_methods(["GET"])
+@metadata_condition(lambda: settings.APTREPO_FILESTORE['gpg_publickey'])
 def gpg_public_key(request):
     """
     Retrieves the GPG public key
@@ -153,39 +278,122 @@ def delete_package_instance(request):
 
 @handle_exception
 @require_http_methods(["GET"])
-def package_list(request, distribution, section, architecture, extension=None):
+@metadata_condition(lambda distribution, section, architecture, extension='': 
+    '{0}/{1}/binary-{2}/Packages{3}'.format(distribution, section, architecture, extension))
+def package_list(request, distribution, section, architecture, extension=''):
     """
     Retrieve a package list
     """
     # TODO caching of HTML rendering of package list 
               
-    is_compressed = False
+    repository = get_repository_controller(request=request)
+    if extension not in repository.get_packages_extensions():
+        return HttpResponse(status=httplib.NOT_FOUND)
+        
+    # stream the stored file matching the ETag unless it must be rebuilt
+    mimetype = _PACKAGES_MIMETYPES.get(extension, 'application/octet-stream')
+    etag = getattr(request, 'metadata_validators', (None, None))[0]
+    packages_file = repository.get_packages_file(distribution, section, architecture, 
+                                                 extension, etag)
+    if packages_file:
+        response = _stream_file_response(request, packages_file, mimetype)
+    else:
+        response = HttpResponse(mimetype=mimetype)
+        response.content = repository.get_packages(distribution, section, architecture,
+                                                   extension)
+        response['Content-Length'] = len(response.content)
     if extension == constants.GZIP_EXTENSION:
-        is_compressed = True
-    elif extension != '':
-        return HttpResponse(status_code=404)
+        response['Content-Encoding'] = 'gzip'
+        
+    return response
+        
+@handle_exception
+@require_http_methods(["GET"])
+@metadata_condition(lambda distribution, section, architecture: 
+    '{0}/{1}/Contents-{2}.gz'.format(distribution, section, architecture))
+def contents_list(request, distribution, section, architecture):
+    """
+    Retrieve the gzipped Contents index of a section
+    """
+    repository = get_repository_controller(request=request)
+    
+    # stream the stored file matching the ETag unless it must be rebuilt
+    mimetype = _PACKAGES_MIMETYPES[constants.GZIP_EXTENSION]
+    etag = getattr(request, 'metadata_validators', (None, None))[0]
+    contents_file = repository.get_contents_file(distribution, section, architecture, etag)
+    if contents_file:
+        return _stream_file_response(request, contents_file, mimetype)
+    
+    data = repository.get_contents(distribution, section, architecture)
+    if data is None:
+        return HttpResponse(status=httplib.NOT_FOUND)
+    
+    response = HttpResponse(data, mimetype=mimetype)
+    response['Content-Length'] = len(data)
+    return response
         
-    mimetype = 'text/plain'
-    if is_compressed:
-        mimetype = 'application/gzip'
+@handle_exception
+@require_http_methods(["GET"])
+def metadata_by_hash(request, distribution, directory, digest):
+    """
+    Retrieve an index file (e.g. a package list) by its SHA256 digest (see Acquire-By-Hash)
+    """
     repository = get_repository_controller(request=request)
-    response = HttpResponse(mimetype=mimetype)
-    response.content = repository.get_packages(distribution, section, architecture,
-                                               is_compressed)
-    response['Content-Length'] = len(response.content)
-    if is_compressed:
-        response['Content-Encoding'] = 'gzip'
+    by_hash_file = repository.get_metadata_file_by_hash(distribution, directory, digest)
+    if by_hash_file is None:
+        return HttpResponse(status=httplib.NOT_FOUND)
+    
+    # the digest identifies the contents, so it is also the file's ETag (see If-Range)
+    request.metadata_validators = (digest, None)
+    response = _stream_file_response(request, by_hash_file, 'application/octet-stream')
+    response['ETag'] = '"{0}"'.format(digest)
+    patch_cache_control(response, public=True, max_age=_IMMUTABLE_MAX_AGE)
+    
+    return response
         
+@handle_exception
+@require_http_methods(["GET"])
+@metadata_condition(lambda distribution, section, architecture, filename: 
+    '{0}/{1}/binary-{2}/Packages.diff/{3}'.format(distribution, section, architecture, 
+                                                  filename))
+def package_list_diff(request, distribution, section, architecture, filename):
+    """
+    Retrieve the PDiff index or a patch of a package list
+    """
+    repository = get_repository_controller(request=request)
+    if filename.endswith(constants.GZIP_EXTENSION):
+        mimetype = _PACKAGES_MIMETYPES[constants.GZIP_EXTENSION]
+    else:
+        mimetype = 'text/plain'
+    
+    # stream the stored file matching the ETag unless it must be rebuilt
+    etag = getattr(request, 'metadata_validators', (None, None))[0]
+    diff_file = repository.get_packages_diff_file(distribution, section, architecture, 
+                                                  filename, etag)
+    if diff_file:
+        response = _stream_file_response(request, diff_file, mimetype)
+    else:
+        data = repository.get_packages_diff(distribution, section, architecture, filename)
+        if data is None:
+            return HttpResponse(status=httplib.NOT_FOUND)
+        response = HttpResponse(data, mimetype=mimetype)
+        response['Content-Length'] = len(data)
+    
+    if filename.endswith(constants.GZIP_EXTENSION):
+        patch_cache_control(response, public=True, max_age=_IMMUTABLE_MAX_AGE)
+    
     return response
         
 @handle_exception
 @require_http_methods(["GET"])
+@metadata_condition(lambda distribution, extension: 
+    '{0}/Release{1}'.format(distribution, extension))
 def release_list(request, distribution, extension):
     """
     Retrieves a Releases metafile list
     """
     repository = get_repository_controller(request=request)
-    (releases_data, signature_data) = repository.get_release_data(distribution)
+    (releases_data, signature_data) = repository.get_release_data(distribution)[:2]
     data = None
     if extension == constants.GPG_EXTENSION:
         data = signature_data
@@ -195,6 +403,29 @@ def release_list(request, distribution, extension):
     # return the response
     return HttpResponse(data, mimetype = 'text/plain')
 
+@handle_exception
+@require_http_methods(["GET"])
+@metadata_condition(lambda distribution: '{0}/InRelease'.format(distribution))
+def inline_release(request, distribution):
+    """
+    Retrieves the inline signed Release metafile (InRelease)
+    """
+    repository = get_repository_controller(request=request)
+    inline_release_data = repository.get_release_data(distribution)[2]
+    return HttpResponse(inline_release_data, mimetype = 'text/plain')
+
+@handle_exception
+@require_http_methods(["GET"])
+def cache_statistics(request):
+    """
+    Retrieves the metadata cache statistics of the serving process (as JSON)
+    """
+    repository = get_repository_controller(request=request)
+    response = HttpResponse(json.dumps(repository.get_cache_statistics()), 
+                            mimetype = 'application/json')
+    patch_cache_control(response, no_cache=True)
+    return response
+
 @handle_exception
 @require_http_methods(["POST"])
 @login_required
@@ -15,10 +15,18 @@ package_urls = patterns('aptrepo.views.webpages.pages',
 aptrepo_metadata_urls = patterns('aptrepo.views.webpages.pages',
     (r'^{0}'.format(settings.APTREPO_FILESTORE['gpg_publickey']), 
         'gpg_public_key'),
+    (r'^(?P<distribution>\w+)/(?P<section>\w+)/binary-(?P<architecture>\w+)/Packages\.diff/(?P<filename>[\w.-]+)$',
+        'package_list_diff'),
+    (r'^(?P<distribution>\w+)/(?P<directory>\w+(/binary-\w+(/Packages\.diff)?)?)/by-hash/SHA256/(?P<digest>[0-9a-f]+)$',
+        'metadata_by_hash'),
     (r'^(?P<distribution>\w+)/(?P<section>\w+)/binary-(?P<architecture>\w+)/Packages(?P<extension>.*)',
         'package_list'),
+    (r'^(?P<distribution>\w+)/(?P<section>\w+)/Contents-(?P<architecture>\w+)\.gz$',
+        'contents_list'),
     (r'^(?P<distribution>\w+)/Release(?P<extension>.*)', 
         'release_list'),
+    (r'^(?P<distribution>\w+)/InRelease$', 
+        'inline_release'),
     (r'^(?P<distribution>\w+)/(?P<section>\w+)/{0,1}$',
         'section_contents_list'),
 )
@@ -31,6 +39,7 @@ urlpatterns = patterns('',
     ),
     url(r'^packages/', include(package_urls)),
     url(r'^dists/', include(aptrepo_metadata_urls)),
+    url(r'^cache/stats/{0,1}$', 'aptrepo.views.webpages.pages.cache_statistics'),
     url(r'^rss/(?P<distribution>\w+)/{0,1}$', DistributionRSSFeed()),
     url(r'^rss/(?P<distribution>\w+)/(?P<section>\w+)/{0,1}$', SectionRSSFeed()),
     url(r'^atom/(?P<distribution>\w+)/{0,1}$', DistributionAtomFeed()),
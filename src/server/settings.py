@@ -74,6 +74,9 @@ MEDIA_ROOT = os.path.join(APTREPO_VAR_ROOT, 'public') + '/'
 # Examples: "http://media.lawrence.com", "http://example.com/media/"
 MEDIA_URL = '/aptrepo/public/'
 
+# Permissions of the stored package files (readable by the front-end web server)
+FILE_UPLOAD_PERMISSIONS = 0644
+
 APTREPO_FILESTORE = {
     'metadata_subdir' : 'dists',
     'packages_subdir' : 'packages',
@@ -81,6 +84,86 @@ APTREPO_FILESTORE = {
     'hash_depth': 2 
 }
 
+# Apply package uploads and removals as deltas to the cached Packages lists
+# instead of clearing all cached metadata for the distribution
+APTREPO_INCREMENTAL_INDEXES = True
+
+# Number of worker threads used to compress and hash the metadata files of a
+# distribution (0 uses one worker per CPU)
+APTREPO_METADATA_WORKERS = 0
+
+# Compressed formats of the Packages lists as (extension, compression level)
+# tuples.  The '.xz' format requires the backports.lzma module.
+APTREPO_PACKAGES_COMPRESSION = (
+    ('.gz', 9),
+    ('.bz2', 9),
+    ('.xz', 6),
+)
+
+# Write the generated metadata (Release, Packages, public key) under
+# MEDIA_ROOT/dists so that the front-end web server can serve it directly and
+# only forward requests for missing files to django.  For example with nginx:
+#
+#   location /aptrepo/dists/ {
+#       alias /oanda/aptrepo/var/public/dists/;
+#       try_files $uri @aptrepo;
+#   }
+#   location ~ ^/aptrepo/dists/.*/by-hash/ {
+#       root /oanda/aptrepo/var/public;
+#       expires max;
+#       try_files $uri @aptrepo;
+#   }
+APTREPO_PUBLISH_METADATA = False
+
+# Directory where the metadata files are otherwise written so that django can 
+# stream them from disk
+APTREPO_METADATA_ROOT = os.path.join(APTREPO_VAR_ROOT, 'metadata')
+
+# Number of generations of each index file retained under the by-hash/
+# directory of its index (see Acquire-By-Hash in the Release file).  Clients
+# fetching a Release file during a rebuild can still download the matching files.
+APTREPO_BY_HASH_GENERATIONS = 3
+
+# Number of ed-style diffs (PDiffs) between generations of each Packages list
+# listed in its Packages.diff/Index, which lets clients download small patches
+# instead of the full list (0 disables PDiffs)
+APTREPO_PDIFF_HISTORY = 14
+
+# Generate a Contents-<arch>.gz index for each section which maps every file to
+# the packages that contain it.  The file lists are captured when packages are
+# uploaded.
+APTREPO_CONTENTS_INDEXES = True
+
+# Publish architecture independent packages once in binary-all/Packages (and 
+# Contents-all.gz) instead of including them in the index of every architecture.
+# 'all' is then listed in the Architectures field of the Release file, which 
+# requires apt 1.0 or later on the clients.  Index files built under the previous
+# value are never reused, but the current metadata is served until a distribution
+# is rebuilt, so run 'manage.py warm' after changing it.
+APTREPO_SEPARATE_ARCHITECTURE_ALL = False
+
+# Defer rebuilding invalidated metadata to the 'regenerate' management command
+# (run as a daemon) instead of clearing it.  The previous metadata is served until
+# a distribution has had no further invalidations for APTREPO_REGENERATION_DELAY
+# seconds (or has waited APTREPO_REGENERATION_MAX_DELAY seconds) and is then
+# rebuilt once.
+APTREPO_BACKGROUND_REGENERATION = False
+APTREPO_REGENERATION_DELAY = 5
+APTREPO_REGENERATION_MAX_DELAY = 60
+
+# Maximum number of seconds that the previous metadata of a distribution may
+# be served after it expired or was invalidated.  Within this period, readers
+# are served the previous metadata immediately while it is rebuilt in a
+# background thread instead of waiting for the rebuild (0 disables this).
+APTREPO_METADATA_MAX_STALENESS = 0
+
+# Maximum size (in bytes) of the metadata kept in memory by each server process
+# in front of the shared cache.  Entries are tied to the generation of their
+# distribution, so a process never serves metadata which has since been
+# rebuilt by another process, and expire with the timeout of the shared cache 
+# (0 disables the in-memory cache).
+APTREPO_MEMORY_CACHE_SIZE = 64 * 1024 * 1024
+
 # URL prefix for admin media -- CSS, JavaScript and images. Make sure to use a
 # trailing slash.
 # Examples: "http://foo.com/media/", "/media/".
@@ -92,6 +175,20 @@ SECRET_KEY = 'o0__bdt)eggafe6gp#4*&^+w7ma-bb1y(6n%o7k2u7)!fyk#8w'
 # Used for GPG signing files
 GPG_SECRET_KEY = os.path.join(APTREPO_CONFIG_ROOT, 'repo-privatekey.asc.gpg')
 
+# Unix socket of the signing daemon (see the 'runsigner' command).  If set, the
+# Release files are signed by the daemon, which is the only process that loads
+# GPG_SECRET_KEY.  Otherwise, each process signs with its own copy of the key.
+APTREPO_SIGNING_SOCKET = None
+
+# Permissions of the signing daemon's socket.  The web server and the management
+# commands connect to it, so when they run as different users, add them to a 
+# common group and set it here (None keeps the daemon user's primary group).
+APTREPO_SIGNING_SOCKET_MODE = 0660
+APTREPO_SIGNING_SOCKET_GROUP = None
+
+# Seconds to wait for the signing daemon to answer a request before failing it
+APTREPO_SIGNING_TIMEOUT = 30
+
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',